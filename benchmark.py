@@ -0,0 +1,536 @@
+# CPU benchmarks for the inference and training paths
+#
+#   python benchmark.py batch --model u2netp --weights saved_models/u2netp/u2netp.pth
+import argparse
+import copy
+import glob
+import os
+import resource
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from skimage import io
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from data_loader import RescaleT
+from data_loader import ToTensorLab
+from data_loader import SalObjDataset
+from data_loader import InferenceDataset
+from data_loader import Augment_prior
+from data_loader import ColorJitter
+from data_loader import ToTensorUint8
+from data_loader import normalize_batch
+from data_loader import salobj_name_lists
+from data_loader import StackSample
+from data_loader import RescaleStackedT
+from data_loader import AugmentPriorStacked
+from data_loader import ColorJitterStacked
+from data_loader import ToTensorStacked
+from data_loader import TPSFieldBank
+from data_loader import tps_remap_maps
+from data_loader import random_tps_shapes
+from data_loader import tps_remap
+
+from inference import load_net
+from inference import benchmark_batch_sizes
+from inference import benchmark_fused
+from inference import benchmark_fusion
+from inference import benchmark_backends
+from inference import OnnxNet
+from model import U2NET
+from model import U2NETP
+from model import fuse_for_inference
+from model import LogitsOutput
+from model import set_activation_checkpointing
+from train_utils import forward_loss
+from train_utils import multi_bce_with_logits_loss
+from train_utils import scheduled_size
+from train_utils import scaled_batch_size
+
+
+def bench_batch(args):
+    net = load_net(args.model, args.weights, args.in_ch)
+
+    print("%10s %12s" % ("batch_size", "images/s"))
+    for batch_size, throughput in benchmark_batch_sizes(net, args.batch_sizes, (args.size,args.size), args.n_images):
+        print("%10d %12.2f" % (batch_size, throughput))
+
+def bench_fused(args):
+    net = load_net(args.model, args.weights, args.in_ch)
+
+    full, fused, max_diff = benchmark_fused(net, args.batch_size, (args.size,args.size), args.n_iters)
+    print("forward (7 outputs): %8.2f ms/image" % (full * 1000))
+    print("forward_fused (d0):  %8.2f ms/image" % (fused * 1000))
+    print("max |d0 - d0_fused|: %g" % max_diff)
+
+def bench_fusion(args):
+    # both models on random weights, or only --model when --weights is given
+    model_names = [args.model] if args.weights else ['u2net','u2netp']
+
+    for model_name in model_names:
+        net = load_net(model_name, args.weights, args.in_ch)
+        fused_net = fuse_for_inference(net)
+
+        unfused, fused, max_diff = benchmark_fusion(net, fused_net, args.batch_size, (args.size,args.size), args.n_iters)
+        print("%s conv+bn:   %8.2f ms/image" % (model_name, unfused * 1000))
+        print("%s folded:    %8.2f ms/image (%.2fx)" % (model_name, fused * 1000, unfused / fused))
+        print("%s max |d0 diff|: %g" % (model_name, max_diff))
+
+def bench_onnx(args):
+    net = load_net(args.model, args.weights, args.in_ch)
+    net.cpu()
+
+    backends = [('eager', net), ('onnxruntime', OnnxNet(args.onnx, args.threads))]
+    results = benchmark_backends([backend for _, backend in backends], args.batch_size, (args.size,args.size), args.n_iters)
+    for (name, _), (seconds, max_diff) in zip(backends, results):
+        print("%-12s %8.2f ms/image  max |d0 diff| %g" % (name, seconds * 1000, max_diff))
+
+def _peak_allocation(fn):
+    # peak Python heap bytes of fn() as seen by tracemalloc (numpy arrays and Python objects,
+    # not the decoders' own C buffers)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak
+
+def _rchar():
+    # bytes this process has read through read() syscalls (Linux /proc/self/io), None elsewhere
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+def _bytes_read(fn):
+    # rchar delta of fn(), minus what reading /proc/self/io itself adds
+    start = _rchar()
+    if start is None:
+        return float('nan')
+    fn()
+    middle = _rchar()
+    empty = _rchar() - middle
+
+    return middle - start - empty
+
+def bench_io(args):
+    img_name_list = sorted(glob.glob(args.image_dir + os.sep + '*'))[:args.n_images]
+
+    old_dataset = SalObjDataset(img_name_list=img_name_list, lbl_name_list=[], pri_name_list=[],
+                                transform=transforms.Compose([RescaleT((args.size,args.size)), ToTensorLab(flag=0)]))
+    new_dataset = InferenceDataset(img_name_list, output_size=(args.size,args.size))
+
+    def old_path(idx):
+        old_dataset[idx]
+        # save_output decoded the file a second time to get the original size
+        io.imread(img_name_list[idx])
+
+    file_bytes = [os.path.getsize(name) for name in img_name_list]
+    old_read = [_bytes_read(lambda: old_path(idx)) for idx in range(len(img_name_list))]
+    new_read = [_bytes_read(lambda: new_dataset[idx]) for idx in range(len(img_name_list))]
+    old_alloc = [_peak_allocation(lambda: old_path(idx)) for idx in range(len(img_name_list))]
+    new_alloc = [_peak_allocation(lambda: new_dataset[idx]) for idx in range(len(img_name_list))]
+
+    print("%-36s %14s %14s %14s" % ("per image", "file bytes", "bytes read", "py heap peak"))
+    print("%-36s %14d %14.0f %14d" % ("SalObjDataset + save_output imread", np.mean(file_bytes), np.mean(old_read), np.mean(old_alloc)))
+    print("%-36s %14d %14.0f %14d" % ("InferenceDataset", np.mean(file_bytes), np.mean(new_read), np.mean(new_alloc)))
+
+def _train_dataset(args, to_tensor):
+    # the training transforms of u2net_train.py with a different last step
+    img_name_list, lbl_name_list, pri_name_list = salobj_name_lists(args.image_dir, args.label_dir, args.prior_dir)
+
+    return SalObjDataset(img_name_list=img_name_list, lbl_name_list=lbl_name_list, pri_name_list=pri_name_list,
+                         transform=transforms.Compose([
+                             Augment_prior(0.5),
+                             RescaleT((args.size,args.size)),
+                             ColorJitter(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05),
+                             to_tensor]))
+
+def _batches_per_second(dataloader, n_batches, prepare=None):
+    # skip the first batch, it includes the worker start-up
+    iterator = iter(dataloader)
+    next(iterator)
+
+    start = time.perf_counter()
+    n = 0
+    for data in iterator:
+        if prepare is not None:
+            data = prepare(data)
+        n += 1
+        if n == n_batches:
+            break
+
+    return n / (time.perf_counter() - start)
+
+def bench_loader(args):
+    transports = [('float', ToTensorLab(flag=0), None), ('uint8', ToTensorUint8(), normalize_batch)]
+
+    print("%11s %10s %10s" % ("num_workers", "transport", "batches/s"))
+    for num_workers in args.num_workers:
+        for name, to_tensor, prepare in transports:
+            dataloader = DataLoader(_train_dataset(args, to_tensor), batch_size=args.batch_size, shuffle=True, num_workers=num_workers)
+            print("%11d %10s %10.2f" % (num_workers, name, _batches_per_second(dataloader, args.n_batches, prepare)))
+
+def bench_transforms(args):
+    img_name_list, lbl_name_list, pri_name_list = salobj_name_lists(args.image_dir, args.label_dir, args.prior_dir)
+    dataset = SalObjDataset(img_name_list=img_name_list[:args.n_samples], lbl_name_list=lbl_name_list[:args.n_samples],
+                            pri_name_list=pri_name_list[:args.n_samples])
+    # decoded once up front, only the transforms are timed
+    samples = [dataset[idx] for idx in range(len(dataset))]
+    size = (args.size,args.size)
+
+    jitter = dict(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05)
+    pipelines = [
+        ('pil', transforms.Compose([Augment_prior(0.5), RescaleT(size), ColorJitter(**jitter), ToTensorUint8()])),
+        ('stacked', transforms.Compose([StackSample(), RescaleStackedT(size), AugmentPriorStacked(0.5), ColorJitterStacked(**jitter), ToTensorStacked()])),
+    ]
+    for name, pipeline in pipelines:
+        start = time.perf_counter()
+        for sample in samples:
+            pipeline(sample)
+        print("%-8s %8.2f ms/sample" % (name, (time.perf_counter() - start) * 1000 / len(samples)))
+
+    # equivalence of the deterministic part: the resize of image, label and prior
+    rescale = RescaleT(size)
+    stacked = transforms.Compose([StackSample(), RescaleStackedT(size)])
+    diffs = []
+    for sample in samples:
+        old = rescale(sample)
+        new = stacked(sample)['stack'].astype(np.float32)
+        old = np.concatenate((old['image'], old['label'], old['prior']), axis=2).astype(np.float32)
+        diffs.append(np.mean(np.abs(old - new), axis=(0,1)))
+    print("mean |RescaleT - RescaleStackedT| per channel (R,G,B,label,prior): %s" % np.round(np.mean(diffs, axis=0), 3))
+
+def _tps_opencv(image, mask, tshape, sshape):
+    # the previous data_ThinPlateSpline: cv2 shape transformer, one warpImage per array
+    tps = cv2.createThinPlateSplineShapeTransformer()
+    matches = [cv2.DMatch(i,i,0) for i in range(len(tshape))]
+    tps.estimateTransformation(tshape.reshape(1,-1,2), sshape.reshape(1,-1,2), matches)
+    return tps.warpImage(image), tps.warpImage(mask)
+
+def bench_tps(args):
+    # smooth random 5-channel samples (RGB, label, prior), the same corner offsets for every method
+    height = width = args.size
+    rng = np.random.RandomState(0)
+    stacks = [cv2.GaussianBlur(rng.randint(0, 256, (height, width, 5)).astype(np.uint8), (0,0), 4) for _ in range(args.n_samples)]
+    shapes = [random_tps_shapes(height, width, args.ratio) for _ in range(args.n_samples)]
+
+    def opencv(stack, shape):
+        return _tps_opencv(np.ascontiguousarray(stack[:,:,:3]), np.ascontiguousarray(stack[:,:,3:]), *shape)
+
+    def remap(stack, shape):
+        maps = tps_remap_maps(*shape, stack.shape[:2])
+        return tps_remap(np.ascontiguousarray(stack[:,:,:3]), maps), tps_remap(np.ascontiguousarray(stack[:,:,3:]), maps)
+
+    def stacked(stack, shape):
+        return tps_remap(stack, tps_remap_maps(*shape, stack.shape[:2]))
+
+    start = time.perf_counter()
+    bank = TPSFieldBank(height, width, size=args.bank_size, ratio=args.ratio)
+    bank_build = time.perf_counter() - start
+
+    def banked(stack, shape):
+        return tps_remap(stack, bank.sample())
+
+    methods = [('opencv', opencv), ('remap', remap), ('stacked', stacked), ('bank', banked)]
+    for name, method in methods:
+        start = time.perf_counter()
+        for stack, shape in zip(stacks, shapes):
+            method(stack, shape)
+        print("%-8s %8.2f ms/sample" % (name, (time.perf_counter() - start) * 1000 / len(stacks)))
+    print("bank of %d fields built in %.2f s" % (args.bank_size, bank_build))
+
+    # parity of the dense field with the cv2 transformer for the same correspondences
+    diffs = []
+    for stack, shape in zip(stacks, shapes):
+        old_image, old_mask = opencv(stack, shape)
+        new = stacked(stack, shape).astype(np.float32)
+        old = np.concatenate((old_image, old_mask.reshape(height, width, -1)), axis=2).astype(np.float32)
+        diffs.append(np.mean(np.abs(old - new)))
+    print("mean |opencv - stacked|: %.3f (of 255)" % np.mean(diffs))
+
+def _synthetic_batches(n_batches, batch_size, in_ch, size, seed=0):
+    # smooth random images with a learnable label: the thresholded first channel
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(n_batches):
+        inputs = torch.rand(batch_size, in_ch, size // 16, size // 16, generator=generator)
+        inputs = F.interpolate(inputs, size=(size,size), mode='bilinear', align_corners=False)
+        labels = (inputs[:,:1] > 0.5).float()
+        batches.append((inputs, labels))
+
+    return batches
+
+def bench_train(args):
+    # one initialization, one sequence of batches, one optimizer setup for every configuration
+    torch.manual_seed(0)
+    initial = (U2NET if args.model == 'u2net' else U2NETP)(args.in_ch, 1)
+    if args.weights:
+        initial.load_state_dict(torch.load(args.weights, map_location='cpu'), strict=False)
+    batches = _synthetic_batches(args.n_steps, args.batch_size, args.in_ch, args.size)
+
+    configs = [('fp32 sigmoid', 'sigmoid', False), ('fp32 logits', 'logits', False), ('bf16 logits', 'logits', True)]
+    report_every = max(1, args.n_steps // 5)
+
+    print("%-14s %10s   %s" % ("config", "ms/step", "loss at steps %s" % list(range(report_every, args.n_steps + 1, report_every))))
+    for name, loss_mode, bf16 in configs:
+        net = copy.deepcopy(initial).train()
+        optimizer = optim.Adam(net.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
+        if loss_mode == 'logits':
+            net = LogitsOutput(net)
+
+        step_times = []
+        losses = []
+        for step, (inputs, labels) in enumerate(batches, 1):
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            _, _, loss = forward_loss(net, inputs, labels, loss_mode, bf16)
+            loss.backward()
+            optimizer.step()
+            step_times.append(time.perf_counter() - start)
+
+            if step % report_every == 0:
+                losses.append(loss.item())
+
+        # the first steps include allocator and oneDNN warm-up
+        step_time = np.mean(step_times[min(2, len(step_times) - 1):])
+        print("%-14s %10.1f   %s" % (name, step_time * 1000, " ".join("%.4f" % l for l in losses)))
+
+def _ddp_worker(rank, world_size, args, port, results):
+    # one torchrun-like process: gloo group on localhost, its share of the cores, synthetic batches
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, args.cores // world_size))
+
+    torch.manual_seed(0)
+    net = (U2NET if args.model == 'u2net' else U2NETP)(args.in_ch, 1).train()
+    optimizer = optim.Adam(net.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
+    train_net = DistributedDataParallel(LogitsOutput(net))
+    batches = _synthetic_batches(args.warmup + args.n_steps, args.batch_size, args.in_ch, args.size, seed=rank)
+
+    for step, (inputs, labels) in enumerate(batches):
+        if step == args.warmup:
+            dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        _, _, loss = forward_loss(train_net, inputs, labels, 'logits')
+        loss.backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put(elapsed)
+    dist.destroy_process_group()
+
+def bench_ddp(args):
+    # weak scaling: every process trains --batch-size samples per step on cores/world_size threads
+    args.cores = args.cores or os.cpu_count()
+    context = mp.get_context('spawn')
+
+    print("%9s %8s %10s %12s %9s %11s" % ("processes", "threads", "ms/step", "samples/s", "speedup", "efficiency"))
+    base = None
+    for port, world_size in enumerate(args.world_sizes, args.port):
+        results = context.SimpleQueue()
+        mp.spawn(_ddp_worker, args=(world_size, args, port, results), nprocs=world_size, join=True)
+        elapsed = results.get()
+
+        throughput = args.n_steps * args.batch_size * world_size / elapsed
+        if base is None:
+            base = throughput / world_size
+        print("%9d %8d %10.1f %12.2f %9.2f %10.0f%%" % (world_size, max(1, args.cores // world_size), elapsed * 1000 / args.n_steps,
+                                                       throughput, throughput / base, throughput / (base * world_size) * 100))
+
+def _checkpointing_worker(args, stages, results):
+    # fresh process per configuration, so ru_maxrss is the peak of this configuration only
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    net = (U2NET if args.model == 'u2net' else U2NETP)(args.in_ch, 1).train()
+    set_activation_checkpointing(net, stages)
+    optimizer = optim.Adam(net.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
+    train_net = LogitsOutput(net)
+    batches = _synthetic_batches(args.warmup + args.n_steps, args.batch_size, args.in_ch, args.size)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    for step, (inputs, labels) in enumerate(batches):
+        if step == args.warmup:
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        _, _, loss = forward_loss(train_net, inputs, labels, 'logits')
+        loss.backward()
+        optimizer.step()
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    results.put((elapsed / args.n_steps, before / 1024, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def bench_checkpointing(args):
+    context = mp.get_context('spawn')
+
+    print("%-10s %10s %14s %14s" % ("stages", "ms/step", "peak RSS MB", "training MB"))
+    for stages in args.stages:
+        results = context.SimpleQueue()
+        process = context.Process(target=_checkpointing_worker, args=(args, stages, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print("%-10s failed with exit code %d" % (stages, process.exitcode))
+            continue
+        step_time, before, peak = results.get()
+        print("%-10s %10.1f %14.0f %14.0f" % (stages, step_time * 1000, peak, peak - before))
+
+def _time_to_loss(args, schedule, validation):
+    # (seconds of training, validation loss at full size) every --eval-every steps
+    torch.manual_seed(0)
+    net = (U2NET if args.model == 'u2net' else U2NETP)(args.in_ch, 1)
+    optimizer = optim.Adam(net.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-08, weight_decay=0)
+    train_net = LogitsOutput(net)
+
+    curve = []
+    elapsed = 0.0
+    for step in range(args.n_steps):
+        size = scheduled_size(schedule, step)
+        batch_size = scaled_batch_size(args.batch_size, size, args.size)
+        (inputs, labels), = _synthetic_batches(1, batch_size, args.in_ch, size, seed=step + 1)
+
+        start = time.perf_counter()
+        net.train()
+        optimizer.zero_grad()
+        _, _, loss = forward_loss(train_net, inputs, labels, 'logits')
+        loss.backward()
+        optimizer.step()
+        elapsed += time.perf_counter() - start
+
+        if (step + 1) % args.eval_every == 0:
+            net.eval()
+            with torch.no_grad():
+                logits = torch.stack(train_net(validation[0]))
+            curve.append((elapsed, multi_bce_with_logits_loss(logits, validation[1])[0].item()))
+
+    return curve
+
+def bench_progressive(args):
+    # schedules in steps instead of epochs; validation on one fixed batch at --size, loss of d0
+    schedule = sorted((int(first), int(size)) for first, size in (step.split(':') for step in args.schedule))
+    validation = _synthetic_batches(1, args.batch_size, args.in_ch, args.size, seed=0)[0]
+
+    configs = [('fixed %d' % args.size, [(0, args.size)]), ('progressive', schedule)]
+    curves = [(name, _time_to_loss(args, config_schedule, validation)) for name, config_schedule in configs]
+
+    # default target: the best validation loss of the fixed-size baseline
+    target = args.target_loss if args.target_loss is not None else min(loss for _, loss in curves[0][1])
+
+    print("target validation loss %.4f" % target)
+    print("%-12s %12s %14s %12s" % ("config", "train s", "best val loss", "s to target"))
+    for name, curve in curves:
+        reached = [seconds for seconds, loss in curve if loss <= target]
+        print("%-12s %12.1f %14.4f %12s" % (name, curve[-1][0], min(loss for _, loss in curve),
+                                            "%.1f" % reached[0] if reached else "not reached"))
+
+def main():
+    parser = argparse.ArgumentParser(description="U2NET / U2NETP benchmarks")
+    parser.add_argument('--model', default='u2netp', choices=['u2net','u2netp'])
+    parser.add_argument('--weights', default=None, help="state_dict .pth, random weights if omitted")
+    parser.add_argument('--in-ch', type=int, default=3, choices=[3,4])
+    parser.add_argument('--size', type=int, default=320)
+    parser.add_argument('--threads', type=int, default=None, help="torch.set_num_threads")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('batch', help="inference throughput for different batch sizes")
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[1,2,4,8,16,32])
+    p.add_argument('--n-images', type=int, default=64)
+    p.set_defaults(func=bench_batch)
+
+    p = subparsers.add_parser('fused', help="forward against forward_fused latency and parity")
+    p.add_argument('--batch-size', type=int, default=1)
+    p.add_argument('--n-iters', type=int, default=20)
+    p.set_defaults(func=bench_fused)
+
+    p = subparsers.add_parser('fusion', help="CPU latency of REBNCONV conv+bn folding")
+    p.add_argument('--batch-size', type=int, default=1)
+    p.add_argument('--n-iters', type=int, default=20)
+    p.set_defaults(func=bench_fusion)
+
+    p = subparsers.add_parser('onnx', help="ONNX Runtime CPU against eager PyTorch, see export_onnx.py")
+    p.add_argument('--onnx', required=True, help="graph exported from the same --weights")
+    p.add_argument('--batch-size', type=int, default=1)
+    p.add_argument('--n-iters', type=int, default=20)
+    p.set_defaults(func=bench_onnx)
+
+    p = subparsers.add_parser('io', help="bytes read (/proc/self/io rchar, Linux) and allocated per test image by the test datasets")
+    p.add_argument('--image-dir', required=True)
+    p.add_argument('--n-images', type=int, default=20)
+    p.set_defaults(func=bench_io)
+
+    p = subparsers.add_parser('loader', help="training batches/s for float64 and uint8 transport over num_workers")
+    p.add_argument('--image-dir', required=True, help="with trailing separator, like u2net_train.py")
+    p.add_argument('--label-dir', required=True)
+    p.add_argument('--prior-dir', required=True)
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--n-batches', type=int, default=20)
+    p.add_argument('--num-workers', type=int, nargs='+', default=[0,1,2,4,8])
+    p.set_defaults(func=bench_loader)
+
+    p = subparsers.add_parser('transforms', help="per-sample time of the PIL and the stacked training transforms")
+    p.add_argument('--image-dir', required=True, help="with trailing separator, like u2net_train.py")
+    p.add_argument('--label-dir', required=True)
+    p.add_argument('--prior-dir', required=True)
+    p.add_argument('--n-samples', type=int, default=50)
+    p.set_defaults(func=bench_transforms)
+
+    p = subparsers.add_parser('tps', help="thin-plate-spline augmentation: cv2 transformer against remap fields")
+    p.add_argument('--n-samples', type=int, default=50)
+    p.add_argument('--ratio', type=float, default=0.02, help="corner offset as a fraction of the size")
+    p.add_argument('--bank-size', type=int, default=64)
+    p.set_defaults(func=bench_tps)
+
+    p = subparsers.add_parser('train', help="training step time and loss curve: fp32 sigmoid/BCELoss, fp32 logits, bf16 logits")
+    p.add_argument('--batch-size', type=int, default=4)
+    p.add_argument('--n-steps', type=int, default=50)
+    p.set_defaults(func=bench_train)
+
+    p = subparsers.add_parser('ddp', help="DistributedDataParallel (gloo) training throughput and scaling efficiency over process counts")
+    p.add_argument('--world-sizes', type=int, nargs='+', default=[1,2,4])
+    p.add_argument('--cores', type=int, default=None, help="cores shared by the processes, all of them by default")
+    p.add_argument('--batch-size', type=int, default=4, help="per process")
+    p.add_argument('--n-steps', type=int, default=20)
+    p.add_argument('--warmup', type=int, default=3)
+    p.add_argument('--port', type=int, default=29531)
+    p.set_defaults(func=bench_ddp)
+
+    p = subparsers.add_parser('checkpointing', help="peak memory against step time for activation checkpointing of the RSU stages")
+    p.add_argument('--stages', nargs='+', default=['none','high-res','encoder','decoder','all'], help="STAGE_GROUPS keys")
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--n-steps', type=int, default=5)
+    p.add_argument('--warmup', type=int, default=1)
+    p.set_defaults(func=bench_checkpointing)
+
+    p = subparsers.add_parser('progressive', help="time to a validation loss: fixed --size against a progressive-resolution schedule")
+    p.add_argument('--schedule', nargs='+', default=['0:160','40:224','80:320'], help="first_step:size")
+    p.add_argument('--batch-size', type=int, default=4, help="at --size, scaled by (size/step size)^2")
+    p.add_argument('--n-steps', type=int, default=120)
+    p.add_argument('--eval-every', type=int, default=10)
+    p.add_argument('--target-loss', type=float, default=None, help="default: best loss of the fixed-size run")
+    p.set_defaults(func=bench_progressive)
+
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
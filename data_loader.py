@@ -1,34 +1,60 @@
 # data loader
 from __future__ import print_function, division
 import glob
+import json
+import os
+import tarfile
+from io import BytesIO
 import torch
+import torch.nn.functional as F
 from skimage import io, transform, color
 import numpy as np
 import random
 import math
 import matplotlib.pyplot as plt
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
 from torchvision import transforms, utils
 from PIL import Image
 import cv2
 
+from inference import prepare_image
+
 ratio_return_unchanged = 0.1
 ratio_do_transform = 0.02
 
 USE_PRIOR = True
 
 # ===================== generate prior channel for input image =====================
+# motion blur kernels for every degree in 5..30 and angle bucket, built once per process
+MOTION_BLUR_DEGREES = (5, 30)
+MOTION_BLUR_ANGLE_STEP = 5
+_motion_blur_kernels = None
+
+def _motion_blur_kernel(degree, angle):
+    M = cv2.getRotationMatrix2D((degree/2, degree/2), angle, 1)
+    motion_blur_kernel = np.diag(np.ones(degree))
+    motion_blur_kernel = cv2.warpAffine(motion_blur_kernel, M, (degree, degree))
+    return np.float32(motion_blur_kernel/degree)
+
+def motion_blur_kernel_bank():
+    # {(degree, angle bucket): kernel}, built on first use
+    global _motion_blur_kernels
+    if _motion_blur_kernels is None:
+        _motion_blur_kernels = {(degree, bucket): _motion_blur_kernel(degree, bucket * MOTION_BLUR_ANGLE_STEP)
+                                for degree in range(MOTION_BLUR_DEGREES[0], MOTION_BLUR_DEGREES[1] + 1)
+                                for bucket in range(360 // MOTION_BLUR_ANGLE_STEP)}
+    return _motion_blur_kernels
+
+def random_motion_blur_kernel():
+    degree = random.randint(*MOTION_BLUR_DEGREES)
+    angle = random.randint(0, 360)
+    return motion_blur_kernel_bank()[(degree, (angle // MOTION_BLUR_ANGLE_STEP) % (360 // MOTION_BLUR_ANGLE_STEP))]
+
 def data_motion_blur(image, mask):
     if random.random()<ratio_return_unchanged:
         return image, mask
     
-    degree = random.randint(5, 30)
-    angle = random.randint(0, 360)
-    
-    M = cv2.getRotationMatrix2D((degree/2, degree/2), angle, 1)
-    motion_blur_kernel = np.diag(np.ones(degree))
-    motion_blur_kernel = cv2.warpAffine(motion_blur_kernel, M, (degree, degree))
-    motion_blur_kernel = motion_blur_kernel/degree
+    motion_blur_kernel = random_motion_blur_kernel()
     
     img_blurred = cv2.filter2D(image, -1, motion_blur_kernel)
     mask_blurred = cv2.filter2D(mask, -1, motion_blur_kernel)
@@ -41,16 +67,34 @@ def data_motion_blur_prior(prior):
     if random.random()<ratio_return_unchanged:
         return prior
     
-    degree = random.randint(5, 30)
-    angle = random.randint(0, 360)
-    
-    M = cv2.getRotationMatrix2D((degree/2, degree/2), angle, 1)
-    motion_blur_kernel = np.diag(np.ones(degree))
-    motion_blur_kernel = cv2.warpAffine(motion_blur_kernel, M, (degree, degree))
-    motion_blur_kernel = motion_blur_kernel/degree
+    motion_blur_kernel = random_motion_blur_kernel()
     
     prior_blurred = cv2.filter2D(prior, -1, motion_blur_kernel)
     return prior_blurred  
+
+def _normalize_minmax_uint8(x):
+    # in-place cv2.normalize(x, x, 0, 255, cv2.NORM_MINMAX) for a (non-contiguous) uint8 view
+    lo, hi = float(x.min()), float(x.max())
+    if hi > lo:
+        x[...] = (x.astype(np.float32) - lo) * (255 / (hi - lo)) + 0.5
+
+def data_motion_blur_stacked(stack, blur_prior=True):
+    """data_motion_blur (+ _prior) on an HxWx5 uint8 stack, one shared kernel and one filter2D."""
+    if random.random()<ratio_return_unchanged:
+        return stack
+
+    motion_blur_kernel = random_motion_blur_kernel()
+
+    if blur_prior:
+        blurred = cv2.filter2D(stack, -1, motion_blur_kernel)
+    else:
+        blurred = stack.copy()
+        blurred[:,:,:4] = cv2.filter2D(np.ascontiguousarray(stack[:,:,:4]), -1, motion_blur_kernel)
+
+    # the mask goes to 0..255, not 0..1 like data_motion_blur, which would binarize a uint8 mask
+    _normalize_minmax_uint8(blurred[:,:,:3])
+    _normalize_minmax_uint8(blurred[:,:,3])
+    return blurred
     
 def data_Affine(image, mask, height, width, bias, ratio=ratio_do_transform):
     if random.random()<ratio_return_unchanged:
@@ -107,51 +151,80 @@ def data_Perspective_prior(prior, height, width, bias, ratio=ratio_do_transform)
 
     return prior_perspective
 
-def data_ThinPlateSpline(image, mask, height, width, ratio=ratio_do_transform):
-    if random.random()<ratio_return_unchanged:
-        return image, mask
+def random_tps_shapes(height, width, ratio):
+    # the random (transforming, target) corner correspondences of the TPS warp
     bias = np.random.randint(-int(height*ratio),int(width*ratio), 16)
 
-    tps = cv2.createThinPlateSplineShapeTransformer()
     sshape = np.array([[0+bias[0],0+bias[1]], [height+bias[2],0+bias[3]], 
                        [0+bias[4],width+bias[5]], [height+bias[6], width+bias[7]]], np.float32)
     tshape = np.array([[0+bias[8],0+bias[9]], [height+bias[10],0+bias[11]], 
                        [0+bias[12],width+bias[13]], [height+bias[14], width+bias[15]]], np.float32)
-    sshape = sshape.reshape(1,-1,2)
-    tshape = tshape.reshape(1,-1,2)
-    matches = list()
-    matches.append(cv2.DMatch(0,0,0))
-    matches.append(cv2.DMatch(1,1,0))
-    matches.append(cv2.DMatch(2,2,0))
-    matches.append(cv2.DMatch(3,3,0))
-    
-    tps.estimateTransformation(tshape, sshape, matches)
-    res = tps.warpImage(image)
-    res_mask = tps.warpImage(mask)
+    return tshape, sshape
+
+def _tps_U(d2):
+    # r^2 log r^2 radial basis of cv2's ThinPlateSplineShapeTransformer, 0 at r = 0
+    return d2 * np.log(np.where(d2 == 0, 1, d2))
+
+def tps_remap_maps(transforming, target, shape):
+    """cv2.remap maps of tps.estimateTransformation(transforming, target) + tps.warpImage at shape."""
+    # output pixel p samples the input at f(p), the spline with f(transforming[i]) = target[i]
+    n = len(transforming)
+    points = transforming.astype(np.float64)
+
+    L = np.zeros((n + 3, n + 3))
+    L[:n,:n] = _tps_U(np.sum((points[:,np.newaxis] - points[np.newaxis]) ** 2, axis=2))
+    L[:n,n] = 1
+    L[:n,n+1:] = points
+    L[n:,:n] = L[:n,n:].T
+    B = np.zeros((n + 3, 2))
+    B[:n] = target
+    params = np.linalg.solve(L, B)
+
+    ys, xs = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float64)
+    maps = params[n] + xs[...,np.newaxis] * params[n+1] + ys[...,np.newaxis] * params[n+2]
+    for i in range(n):
+        maps += _tps_U((xs - points[i,0]) ** 2 + (ys - points[i,1]) ** 2)[...,np.newaxis] * params[i]
+
+    return cv2.convertMaps(np.float32(maps[...,0]), np.float32(maps[...,1]), cv2.CV_16SC2)
+
+def tps_remap(image, maps):
+    # warpImage defaults: bilinear, constant 0 border
+    return cv2.remap(image, maps[0], maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+class TPSFieldBank(object):
+    """Random TPS remap maps pre-computed for one working resolution; sample() draws one."""
+
+    def __init__(self, height, width, size=64, ratio=ratio_do_transform):
+        self.fields = [tps_remap_maps(*random_tps_shapes(height, width, ratio), (height, width)) for _ in range(size)]
+
+    def sample(self):
+        return self.fields[random.randrange(len(self.fields))]
+
+def data_ThinPlateSpline(image, mask, height, width, ratio=ratio_do_transform, bank=None):
+    if random.random()<ratio_return_unchanged:
+        return image, mask
+
+    maps = bank.sample() if bank is not None else tps_remap_maps(*random_tps_shapes(height, width, ratio), image.shape[:2])
+    res = tps_remap(image, maps)
+    res_mask = tps_remap(mask, maps)
     return res, res_mask   
 
-def data_ThinPlateSpline_prior(prior, height, width, ratio=ratio_do_transform):
+def data_ThinPlateSpline_prior(prior, height, width, ratio=ratio_do_transform, bank=None):
     if random.random()<ratio_return_unchanged:
         return prior
-    bias = np.random.randint(-int(height*ratio),int(width*ratio), 16)
 
-    tps = cv2.createThinPlateSplineShapeTransformer()
-    sshape = np.array([[0+bias[0],0+bias[1]], [height+bias[2],0+bias[3]], 
-                       [0+bias[4],width+bias[5]], [height+bias[6], width+bias[7]]], np.float32)
-    tshape = np.array([[0+bias[8],0+bias[9]], [height+bias[10],0+bias[11]], 
-                       [0+bias[12],width+bias[13]], [height+bias[14], width+bias[15]]], np.float32)
-    sshape = sshape.reshape(1,-1,2)
-    tshape = tshape.reshape(1,-1,2)
-    matches = list()
-    matches.append(cv2.DMatch(0,0,0))
-    matches.append(cv2.DMatch(1,1,0))
-    matches.append(cv2.DMatch(2,2,0))
-    matches.append(cv2.DMatch(3,3,0))
-    
-    tps.estimateTransformation(tshape, sshape, matches)
-    prior = tps.warpImage(prior)
+    maps = bank.sample() if bank is not None else tps_remap_maps(*random_tps_shapes(height, width, ratio), prior.shape[:2])
+    prior = tps_remap(prior, maps)
     return prior
 
+def data_ThinPlateSpline_stacked(stack, height, width, ratio=ratio_do_transform, bank=None):
+    # data_ThinPlateSpline for all channels of an HxWxC stack with a single cv2.remap
+    if random.random()<ratio_return_unchanged:
+        return stack
+
+    maps = bank.sample() if bank is not None else tps_remap_maps(*random_tps_shapes(height, width, ratio), stack.shape[:2])
+    return tps_remap(stack, maps)
+
 class Augment_prior(object):
 
 	def __init__(self, prior_prob):
@@ -243,6 +316,109 @@ class RescaleT(object):
 
 		return {'imidx':imidx, 'image':image,'label':label, 'prior':prior}
 
+# ===================== single HxWx5 uint8 stack transforms =====================
+# channels 0-2 RGB, 3 label, 4 prior; one cv2 call per geometric op for all channels
+
+def _random_affine_inverse(width, height, degrees, translate, shear):
+	# output -> input pixel mapping of transforms.RandomAffine(degrees, translate, shear=(shear,shear,shear,shear))
+	angle = math.radians(random.uniform(-degrees, degrees))
+	tx = round(random.uniform(-translate[0] * width, translate[0] * width))
+	ty = round(random.uniform(-translate[1] * height, translate[1] * height))
+	sx = math.radians(shear)
+	sy = math.radians(shear)
+	cx, cy = width * 0.5, height * 0.5
+
+	a = math.cos(angle - sy) / math.cos(sy)
+	b = -math.cos(angle - sy) * math.tan(sx) / math.cos(sy) - math.sin(angle)
+	c = math.sin(angle - sy) / math.cos(sy)
+	d = -math.sin(angle - sy) * math.tan(sx) / math.cos(sy) + math.cos(angle)
+
+	M = np.array([[d, -b, 0.0], [-c, a, 0.0]])
+	M[:,2] = M[:,:2] @ np.array([-cx - tx, -cy - ty]) + np.array([cx, cy])
+
+	return M
+
+class StackSample(object):
+	"""Pack image, label and prior of a SalObjDataset sample into one HxWx5 uint8 'stack'."""
+
+	def __call__(self,sample):
+		imidx, image, label, prior = sample['imidx'], sample['image'],sample['label'], sample['prior']
+
+		stack = np.empty((image.shape[0], image.shape[1], 5), dtype=np.uint8)
+		stack[:,:,:3] = image[:,:,:3] # grayscale images broadcast to RGB
+		stack[:,:,3] = label[:,:,0]
+		stack[:,:,4] = prior[:,:,0]
+
+		return {'imidx':imidx, 'stack':stack}
+
+class RescaleStackedT(object):
+	"""RescaleT for the stack: all five channels in a single cv2.resize."""
+
+	def __init__(self,output_size):
+		assert isinstance(output_size,(int,tuple))
+		self.output_size = output_size if isinstance(output_size, tuple) else (output_size, output_size)
+
+	def __call__(self,sample):
+		stack = sample['stack']
+		height, width = self.output_size
+
+		if stack.shape[:2] != (height, width):
+			shrink = stack.shape[0] > height or stack.shape[1] > width
+			stack = cv2.resize(stack, (width, height), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+
+		return {'imidx':sample['imidx'], 'stack':stack}
+
+class AugmentPriorStacked(object):
+	"""Augment_prior on the stack: the prior is cleared with probability 1-prior_prob,
+	otherwise warped by the same small random affine as Augment_prior, with one cv2.warpAffine."""
+
+	def __init__(self, prior_prob):
+
+		self.prior_prob = prior_prob
+
+	def __call__(self,sample):
+		stack = sample['stack']
+		if not stack.flags.writeable:
+			stack = stack.copy()
+		height, width = stack.shape[:2]
+
+		if self.prior_prob >= random.random():
+			M = _random_affine_inverse(width, height, degrees=1, translate=(0.01, 0.01), shear=2)
+			stack[:,:,4] = cv2.warpAffine(np.ascontiguousarray(stack[:,:,4]), M, (width, height),
+										  flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+										  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+		else:
+			stack[:,:,4] = 0
+
+		return {'imidx':sample['imidx'], 'stack':stack}
+
+class ColorJitterStacked(object):
+	"""ColorJitter applied to the RGB slice of the stack only."""
+
+	def __init__(self,brightness,contrast,saturation,hue):
+
+		self.jitter = transforms.ColorJitter(brightness=brightness, contrast=contrast, saturation=saturation, hue=hue)
+
+	def __call__(self,sample):
+		stack = sample['stack']
+		if not stack.flags.writeable:
+			stack = stack.copy()
+
+		stack[:,:,:3] = np.asarray(self.jitter(Image.fromarray(np.ascontiguousarray(stack[:,:,:3]))))
+
+		return {'imidx':sample['imidx'], 'stack':stack}
+
+class ToTensorStacked(object):
+	"""Stack -> the uint8 tensors of ToTensorUint8 (image+prior 4xHxW, label 1xHxW), scale them with normalize_batch."""
+
+	def __call__(self,sample):
+		stack = sample['stack']
+
+		tmpImg = np.ascontiguousarray(np.moveaxis(stack[:,:,[0,1,2,4]], 2, 0))
+		tmpLbl = np.ascontiguousarray(np.moveaxis(stack[:,:,3:4], 2, 0))
+
+		return {'imidx':torch.from_numpy(sample['imidx']), 'image': torch.from_numpy(tmpImg), 'label': torch.from_numpy(tmpLbl)}
+
 class RandomCrop(object):
 
 	def __init__(self,output_size):
@@ -352,6 +528,179 @@ class ToTensorLab(object):
 		return {'imidx':torch.from_numpy(imidx), 'image': torch.from_numpy(tmpImg), 'label': torch.from_numpy(tmpLbl)}
 
 
+class ToTensorUint8(object):
+	"""Convert ndarrays in sample to uint8 Tensors; normalize_batch on the collated batch gives ToTensorLab's values."""
+
+	def __call__(self, sample):
+
+		imidx, image, label, prior = sample['imidx'], sample['image'], sample['label'], sample['prior']
+
+		if image.shape[2]==1:
+			image = np.concatenate((image,image,image), axis=2)
+
+		tmpImg = np.concatenate((image[:,:,:3].astype(np.uint8), prior[:,:,:1].astype(np.uint8)), axis=2)
+
+		tmpImg = np.ascontiguousarray(np.moveaxis(tmpImg, 2, 0))
+		tmpLbl = np.ascontiguousarray(np.moveaxis(label[:,:,:1].astype(np.uint8), 2, 0))
+
+		return {'imidx':torch.from_numpy(imidx), 'image': torch.from_numpy(tmpImg), 'label': torch.from_numpy(tmpLbl)}
+
+def _scale_by_max(x):
+	# x / max(x) per sample, unchanged where the maximum is ~0, like ToTensorLab
+	ma = torch.amax(x, dim=(1,2,3), keepdim=True)
+
+	return torch.where(ma >= 1e-6, x / ma.clamp(min=1e-6), x)
+
+def normalize_batch(data):
+	# float32 batch from ToTensorUint8 samples, with the values ToTensorLab would have produced
+	image = data['image'].float()
+	image[:,:3] /= 255
+	image[:,3:] = _scale_by_max(image[:,3:])
+
+	label = _scale_by_max(data['label'].float())
+
+	return {'imidx':data['imidx'], 'image':image, 'label':label}
+
+# YIQ <-> RGB, the hue shift of BatchAugment is a rotation of the I/Q plane
+_RGB_TO_YIQ = torch.tensor([[0.299, 0.587, 0.114],
+							[0.596, -0.274, -0.322],
+							[0.211, -0.523, 0.312]])
+_YIQ_TO_RGB = torch.inverse(_RGB_TO_YIQ)
+
+class BatchAugment(object):
+	"""ColorJitter and Augment_prior on a collated [B,4,H,W] float batch, random per sample."""
+
+	def __init__(self, brightness=(0.8,1.2), contrast=(0.8,1.2), saturation=(0.9,1.1), hue=0.05,
+				 prior_prob=0.5, degrees=1, translate=(0.01,0.01), shear=2):
+
+		self.brightness = brightness
+		self.contrast = contrast
+		self.saturation = saturation
+		self.hue = hue
+		self.prior_prob = prior_prob
+		self.degrees = degrees
+		self.translate = translate
+		self.shear = shear
+
+	@staticmethod
+	def _uniform(batch_size, low, high, like):
+		return torch.empty(batch_size, device=like.device, dtype=like.dtype).uniform_(low, high)
+
+	def color_jitter(self, rgb):
+		B = rgb.shape[0]
+
+		rgb = (rgb * self._uniform(B, *self.brightness, rgb).view(B,1,1,1)).clamp(0, 1)
+
+		gray = (rgb * _RGB_TO_YIQ[0].to(rgb).view(1,3,1,1)).sum(dim=1, keepdim=True)
+		mean = gray.mean(dim=(1,2,3), keepdim=True)
+		contrast = self._uniform(B, *self.contrast, rgb).view(B,1,1,1)
+		rgb = (mean + (rgb - mean) * contrast).clamp(0, 1)
+
+		gray = (rgb * _RGB_TO_YIQ[0].to(rgb).view(1,3,1,1)).sum(dim=1, keepdim=True)
+		saturation = self._uniform(B, *self.saturation, rgb).view(B,1,1,1)
+		rgb = (gray + (rgb - gray) * saturation).clamp(0, 1)
+
+		if self.hue > 0:
+			theta = self._uniform(B, -self.hue, self.hue, rgb) * 2 * math.pi
+			rotation = torch.zeros(B, 3, 3, device=rgb.device, dtype=rgb.dtype)
+			rotation[:,0,0] = 1
+			rotation[:,1,1] = torch.cos(theta)
+			rotation[:,1,2] = -torch.sin(theta)
+			rotation[:,2,1] = torch.sin(theta)
+			rotation[:,2,2] = torch.cos(theta)
+			M = _YIQ_TO_RGB.to(rgb) @ rotation @ _RGB_TO_YIQ.to(rgb)
+			rgb = torch.einsum('bij,bjhw->bihw', M, rgb).clamp(0, 1)
+
+		return rgb
+
+	def prior_affine(self, prior):
+		B, _, H, W = prior.shape
+
+		# per-sample output -> input pixel mapping, as in _random_affine_inverse
+		angle = self._uniform(B, -self.degrees, self.degrees, prior) * math.pi / 180
+		tx = torch.round(self._uniform(B, -self.translate[0] * W, self.translate[0] * W, prior))
+		ty = torch.round(self._uniform(B, -self.translate[1] * H, self.translate[1] * H, prior))
+		sx = sy = math.radians(self.shear)
+
+		a = torch.cos(angle - sy) / math.cos(sy)
+		b = -torch.cos(angle - sy) * math.tan(sx) / math.cos(sy) - torch.sin(angle)
+		c = torch.sin(angle - sy) / math.cos(sy)
+		d = -torch.sin(angle - sy) * math.tan(sx) / math.cos(sy) + torch.cos(angle)
+
+		cx, cy = W * 0.5, H * 0.5
+		inverse = torch.zeros(B, 3, 3, device=prior.device, dtype=prior.dtype)
+		inverse[:,0,0], inverse[:,0,1] = d, -b
+		inverse[:,1,0], inverse[:,1,1] = -c, a
+		inverse[:,0,2] = d * (-cx - tx) - b * (-cy - ty) + cx
+		inverse[:,1,2] = -c * (-cx - tx) + a * (-cy - ty) + cy
+		inverse[:,2,2] = 1
+
+		# pixel <-> normalized coordinates of affine_grid (align_corners=False)
+		to_norm = torch.tensor([[2.0 / W, 0, 1.0 / W - 1], [0, 2.0 / H, 1.0 / H - 1], [0, 0, 1]], device=prior.device, dtype=prior.dtype)
+		theta = (to_norm @ inverse @ torch.inverse(to_norm))[:,:2]
+
+		grid = F.affine_grid(theta, prior.shape, align_corners=False)
+		prior = F.grid_sample(prior, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+		keep = (torch.rand(B, device=prior.device) <= self.prior_prob).to(prior.dtype).view(B,1,1,1)
+
+		return prior * keep
+
+	def __call__(self, data):
+		image = data['image']
+
+		image = torch.cat((self.color_jitter(image[:,:3]), self.prior_affine(image[:,3:4])), dim=1)
+
+		return {'imidx':data['imidx'], 'image':image, 'label':data['label']}
+
+def salobj_name_lists(image_dir, label_dir, prior_dir, image_ext='.png', label_ext='.png', prior_ext='.png'):
+	# image paths and the label / prior paths with the same file name
+	img_name_list = glob.glob(image_dir + '*' + image_ext)
+
+	lbl_name_list = []
+	pri_name_list = []
+	for img_path in img_name_list:
+		img_name = img_path.split(os.sep)[-1]
+
+		aaa = img_name.split(".")
+		bbb = aaa[0:-1]
+		imidx = bbb[0]
+		for i in range(1,len(bbb)):
+			imidx = imidx + "." + bbb[i]
+
+		lbl_name_list.append(label_dir + imidx + label_ext)
+		pri_name_list.append(prior_dir + imidx + prior_ext)
+
+	return img_name_list, lbl_name_list, pri_name_list
+
+def _salobj_sample(imidx, image, label_3, prior_3):
+	# single-channel HxWx1 label and prior next to the decoded image
+	label = np.zeros(label_3.shape[0:2])
+	if(3==len(label_3.shape)):
+		label = label_3[:,:,0]
+	elif(2==len(label_3.shape)):
+		label = label_3
+
+	prior = np.zeros(prior_3.shape[0:2])
+	if(3==len(prior_3.shape)):
+		prior = prior_3[:,:,0]
+	elif(2==len(prior_3.shape)):
+		prior = prior_3
+
+	if(3==len(image.shape) and 2==len(label.shape)):
+		label = label[:,:,np.newaxis]
+	elif(2==len(image.shape) and 2==len(label.shape)):
+		image = image[:,:,np.newaxis]
+		label = label[:,:,np.newaxis]
+
+	if(3==len(image.shape) and 2==len(prior.shape)):
+		prior = prior[:,:,np.newaxis]
+	elif(2==len(image.shape) and 2==len(prior.shape)):
+		image = image[:,:,np.newaxis]
+		prior = prior[:,:,np.newaxis]
+
+	return {'imidx':imidx, 'image':image, 'label':label, 'prior':prior}
+
 class SalObjDataset(Dataset):
 	def __init__(self, img_name_list, lbl_name_list, pri_name_list, transform=None):
 
@@ -380,33 +729,234 @@ class SalObjDataset(Dataset):
 		else:
 			prior_3 = io.imread(self.prior_name_list[idx])
 
-		label = np.zeros(label_3.shape[0:2])
-		if(3==len(label_3.shape)):
-			label = label_3[:,:,0]
-		elif(2==len(label_3.shape)):
-			label = label_3
+		sample = _salobj_sample(imidx, image, label_3, prior_3)
+
+		if self.transform:
+			sample = self.transform(sample)
+
+		return sample
+
+class InferenceDataset(Dataset):
+	"""Test-time dataset that decodes every image file exactly once.
+
+	There are no label or prior buffers. A sample carries the resized
+	3xHxW float32 model input (resized like RescaleT), the original
+	(height, width) and, with keep_original=True, the decoded uint8 pixels
+	for the output stage. Batch it with inference_collate.
+	"""
+	def __init__(self, img_name_list, output_size=(320,320), keep_original=False):
+
+		self.image_name_list = sorted(img_name_list)
+		self.output_size = output_size
+		self.keep_original = keep_original
+
+	def __len__(self):
+		return len(self.image_name_list)
+
+	def __getitem__(self,idx):
 
-		prior = np.zeros(prior_3.shape[0:2])
-		if(3==len(prior_3.shape)):
-			prior = prior_3[:,:,0]
-		elif(2==len(prior_3.shape)):
-			prior = prior_3
+		image = io.imread(self.image_name_list[idx])
+		resized = prepare_image(image, self.output_size)
 
-		if(3==len(image.shape) and 2==len(label.shape)):
-			label = label[:,:,np.newaxis]
-		elif(2==len(image.shape) and 2==len(label.shape)):
-			image = image[:,:,np.newaxis]
-			label = label[:,:,np.newaxis]
+		sample = {'imidx':np.array([idx]), 'image':torch.from_numpy(np.ascontiguousarray(resized)), 'size':image.shape[:2],
+				  'name':self.image_name_list[idx]}
+		if self.keep_original:
+			sample['original'] = image
 
-		if(3==len(image.shape) and 2==len(prior.shape)):
-			prior = prior[:,:,np.newaxis]
-		elif(2==len(image.shape) and 2==len(prior.shape)):
-			image = image[:,:,np.newaxis]
-			prior = prior[:,:,np.newaxis]
+		return sample
+
+def inference_collate(batch):
+	# stack the model inputs, keep sizes, names and original pixels as per-image lists
+	data = {'imidx':torch.from_numpy(np.concatenate([sample['imidx'] for sample in batch])),
+			'image':torch.stack([sample['image'] for sample in batch]),
+			'size':[sample['size'] for sample in batch],
+			'name':[sample['name'] for sample in batch]}
+	if 'original' in batch[0]:
+		data['original'] = [sample['original'] for sample in batch]
+
+	return data
+
+# ===================== preprocessed memory-mapped training cache =====================
+def _list_collate(batch):
+	return batch
+
+def build_salobj_cache(img_name_list, lbl_name_list, pri_name_list, cache_path, output_size=(320,320), num_workers=4):
+	"""Decode and RescaleT every sample once into an N x H x W x 5 uint8 .npy cache for CachedSalObjDataset."""
+	dataset = SalObjDataset(img_name_list, lbl_name_list, pri_name_list, transform=RescaleT(output_size))
+	height, width = output_size if isinstance(output_size, tuple) else (output_size, output_size)
+
+	data = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.uint8, shape=(len(dataset), height, width, 5))
+	loader = DataLoader(dataset, batch_size=16, shuffle=False, num_workers=num_workers, collate_fn=_list_collate)
+
+	idx = 0
+	for batch in loader:
+		for sample in batch:
+			data[idx,:,:,:3] = sample['image'][:,:,:3] # grayscale images broadcast to RGB
+			data[idx,:,:,3] = sample['label'][:,:,0]
+			data[idx,:,:,4] = sample['prior'][:,:,0]
+			idx += 1
+		print("cached %d/%d" % (idx, len(dataset)))
+	data.flush()
+	del data
+
+	with open(cache_path + '.json', 'w') as f:
+		json.dump({'size':[height, width],
+				   'image':dataset.image_name_list,
+				   'label':dataset.label_name_list,
+				   'prior':dataset.prior_name_list}, f)
+
+class CachedSalObjDataset(Dataset):
+	"""SalObjDataset samples as zero-copy views into the memory-mapped build_salobj_cache array; skip RescaleT."""
+	def __init__(self, cache_path, transform=None):
+
+		self.cache_path = cache_path
+		self.transform = transform
+		self.data = None
 
-		sample = {'imidx':imidx, 'image':image, 'label':label, 'prior':prior}
+		with open(cache_path + '.json') as f:
+			self.image_name_list = json.load(f)['image']
+
+	def __len__(self):
+		return len(self.image_name_list)
+
+	def __getitem__(self,idx):
+
+		if self.data is None:
+			self.data = np.load(self.cache_path, mmap_mode='r')
+
+		packed = self.data[idx]
+		sample = {'imidx':np.array([idx]), 'image':packed[:,:,:3], 'label':packed[:,:,3:4], 'prior':packed[:,:,4:5]}
 
 		if self.transform:
 			sample = self.transform(sample)
 
 		return sample
+
+	def __getstate__(self):
+		# never pickle the mapped array into the workers
+		state = self.__dict__.copy()
+		state['data'] = None
+		return state
+
+# ===================== sequential tar shards =====================
+def _name_stem(path):
+	return os.path.splitext(os.path.basename(path))[0]
+
+def _match_names(img_name_list, name_list, field):
+	# name_list reordered to img_name_list by file name; an empty list stays empty
+	if len(name_list) == 0:
+		return []
+	by_stem = {_name_stem(name): name for name in name_list}
+	matched = []
+	for img_name in img_name_list:
+		if _name_stem(img_name) not in by_stem:
+			raise FileNotFoundError("no %s file for image %s" % (field, img_name))
+		matched.append(by_stem[_name_stem(img_name)])
+	return matched
+
+def write_salobj_shards(img_name_list, lbl_name_list, pri_name_list, shard_dir, samples_per_shard=1000):
+	"""Pack the original image, label and prior bytes of each sample into shard_dir/shard-%06d.tar plus index.json."""
+	# label and prior of each image matched by file name, like salobj_name_lists
+	img_name_list = sorted(img_name_list)
+	lbl_name_list = _match_names(img_name_list, lbl_name_list, 'label')
+	pri_name_list = _match_names(img_name_list, pri_name_list, 'prior')
+
+	if not os.path.exists(shard_dir):
+		os.makedirs(shard_dir, exist_ok=True)
+
+	shards = []
+	for shard_idx, start in enumerate(range(0, len(img_name_list), samples_per_shard)):
+		shard_name = 'shard-%06d.tar' % shard_idx
+		with tarfile.open(os.path.join(shard_dir, shard_name), 'w') as tar:
+			for idx in range(start, min(start + samples_per_shard, len(img_name_list))):
+				for field, names in (('image', img_name_list), ('label', lbl_name_list), ('prior', pri_name_list)):
+					if len(names) == 0:
+						continue
+					ext = os.path.splitext(names[idx])[1]
+					tar.add(names[idx], arcname='%08d.%s%s' % (idx, field, ext))
+		shards.append({'name':shard_name, 'samples':min(samples_per_shard, len(img_name_list) - start)})
+		print("wrote %s" % shard_name)
+
+	with open(os.path.join(shard_dir, 'index.json'), 'w') as f:
+		json.dump({'shards':shards, 'image':img_name_list, 'label':lbl_name_list, 'prior':pri_name_list}, f)
+
+def _read_shard(path):
+	# (key, {field: bytes}) per sample, reading the tar front to back
+	key, fields = None, {}
+	with tarfile.open(path, 'r|') as tar:
+		for member in tar:
+			if not member.isfile():
+				continue
+			member_key, field = member.name.split('.')[:2]
+			if key is not None and member_key != key:
+				yield key, fields
+				fields = {}
+			key = member_key
+			fields[field] = tar.extractfile(member).read()
+	if key is not None:
+		yield key, fields
+
+def _decode_png(data, mode):
+	# explicit mode so palette PNGs decode to pixel values, not palette indices
+	return np.array(Image.open(BytesIO(data)).convert(mode))
+
+class ShardedSalObjDataset(IterableDataset):
+	"""Streaming SalObjDataset over write_salobj_shards tar shards, reshuffled per set_epoch(); use shuffle=False."""
+	def __init__(self, shard_dir, transform=None, shuffle_buffer=512, seed=0, num_replicas=1, rank=0):
+
+		with open(os.path.join(shard_dir, 'index.json')) as f:
+			index = json.load(f)
+
+		self.shard_paths = [os.path.join(shard_dir, shard['name']) for shard in index['shards']]
+		self.num_samples = sum(shard['samples'] for shard in index['shards'])
+		self.transform = transform
+		self.shuffle_buffer = shuffle_buffer
+		self.seed = seed
+		self.epoch = 0
+		self.num_replicas = num_replicas
+		self.rank = rank
+
+	def __len__(self):
+		# approximate per process, shards are split between the processes
+		return self.num_samples // self.num_replicas
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def _sample(self, key, fields):
+		image = _decode_png(fields['image'], 'RGB')
+		label_3 = _decode_png(fields['label'], 'L') if 'label' in fields else np.zeros(image.shape)
+		prior_3 = _decode_png(fields['prior'], 'L') if 'prior' in fields else np.zeros(image.shape)
+
+		sample = _salobj_sample(np.array([int(key)]), image, label_3, prior_3)
+		if self.transform:
+			sample = self.transform(sample)
+
+		return sample
+
+	def __iter__(self):
+		worker_info = get_worker_info()
+		worker_id = worker_info.id if worker_info is not None else 0
+		num_workers = worker_info.num_workers if worker_info is not None else 1
+
+		# same shard order in every process and worker, each one takes every
+		# (num_replicas * num_workers)-th shard
+		shard_paths = list(self.shard_paths)
+		random.Random(self.seed + self.epoch).shuffle(shard_paths)
+		reader = self.rank * num_workers + worker_id
+		shard_paths = shard_paths[reader::self.num_replicas * num_workers]
+
+		rng = random.Random((self.seed + self.epoch) * 1000 + reader)
+		buffer = []
+		for shard_path in shard_paths:
+			for item in _read_shard(shard_path):
+				if len(buffer) < self.shuffle_buffer:
+					buffer.append(item)
+					continue
+				i = rng.randrange(len(buffer))
+				item, buffer[i] = buffer[i], item
+				yield self._sample(*item)
+
+		rng.shuffle(buffer)
+		for item in buffer:
+			yield self._sample(*item)
@@ -0,0 +1,58 @@
+# export U2NET / U2NETP from a state_dict to ONNX with a dynamic batch dimension
+#
+#   python export_onnx.py --model u2netp --in-ch 4 --weights saved_models/u2netp/Best1_320px.pth \
+#       --output saved_models/u2netp/Best1_320px.onnx
+#
+# The graph has one input 'input' (N x in_ch x H x W, float32 in [0,1]) and one output
+# 'd0' (N x 1 x H x W sigmoid map). Setting model_dir in the test scripts to the .onnx
+# file runs them through ONNX Runtime instead of eager PyTorch.
+import argparse
+
+import torch
+
+from model import FusedOutput
+from inference import load_net
+from inference import OnnxNet
+from inference import benchmark_backends
+
+
+def export_onnx(net, output, in_ch, size=(320,320), opset=17, dynamic_size=False):
+    model = FusedOutput(net).cpu().eval()
+    dummy = torch.rand(1, in_ch, size[0], size[1])
+
+    dynamic_axes = {'input': {0: 'batch'}, 'd0': {0: 'batch'}}
+    if dynamic_size:
+        dynamic_axes = {'input': {0: 'batch', 2: 'height', 3: 'width'}, 'd0': {0: 'batch', 2: 'height', 3: 'width'}}
+
+    torch.onnx.export(model, dummy, output,
+                      input_names=['input'],
+                      output_names=['d0'],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset,
+                      do_constant_folding=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="export U2NET / U2NETP to ONNX")
+    parser.add_argument('--model', default='u2netp', choices=['u2net','u2netp'])
+    parser.add_argument('--weights', required=True, help="state_dict .pth")
+    parser.add_argument('--in-ch', type=int, default=3, choices=[3,4], help="4 for the variant with a prior channel")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--size', type=int, default=320)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--dynamic-size', action='store_true', help="also make height and width dynamic")
+    parser.add_argument('--no-check', action='store_true', help="skip the parity check against eager PyTorch")
+    args = parser.parse_args()
+
+    net = load_net(args.model, args.weights, args.in_ch)
+    net.cpu()
+
+    export_onnx(net, args.output, args.in_ch, (args.size,args.size), args.opset, args.dynamic_size)
+    print("saved", args.output)
+
+    if not args.no_check:
+        # batch of 2 to exercise the dynamic batch dimension
+        results = benchmark_backends([net, OnnxNet(args.output)], batch_size=2, size=(args.size,args.size), n_iters=1, warmup=0)
+        print("max |d0 eager - d0 onnx|: %g" % results[1][1])
+
+if __name__ == "__main__":
+    main()
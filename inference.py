@@ -0,0 +1,485 @@
+# batched inference helpers shared by the test scripts
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from model import U2NET # full size version 173.6 MB
+from model import U2NETP # small version u2net 4.7 MB
+from model import fuse_for_inference
+
+
+class ScriptedNet(torch.nn.Module):
+    # torchscript model that returns d0, e.g. the INT8 U2NETP written by quantize.py
+
+    def __init__(self, module, in_ch=3):
+        super(ScriptedNet,self).__init__()
+
+        self.module = module
+        self.in_ch = in_ch
+
+    def forward(self,x):
+
+        return self.module(x)
+
+def load_scripted(model_dir):
+    # the number of input channels is stored next to the graph as an extra file
+    extra_files = {'in_ch': ''}
+    module = torch.jit.load(model_dir, map_location='cpu', _extra_files=extra_files)
+    module.eval()
+
+    return ScriptedNet(module, int(extra_files['in_ch'] or 3))
+
+def save_scripted(module, example_inputs, model_dir):
+    traced = torch.jit.trace(module, example_inputs)
+    torch.jit.save(traced, model_dir, _extra_files={'in_ch': str(example_inputs.shape[1])})
+
+class OnnxNet(object):
+    # ONNX Runtime CPU session with the same call interface as the torch models, returns d0
+
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.in_ch = model_input.shape[1]
+
+    def __call__(self,x):
+
+        d0 = self.session.run(None, {self.input_name: x.cpu().numpy().astype(np.float32)})[0]
+
+        return torch.from_numpy(d0)
+
+def load_net(model_name, model_dir=None, in_ch=3, fuse=False):
+    # build U2NET / U2NETP and load a state_dict saved by u2net_train.py
+    # fuse=True folds every REBNCONV batchnorm into its conv (inference only)
+    # a .pt model_dir is loaded as torchscript instead, e.g. the INT8 model from quantize.py,
+    # and a .onnx model_dir runs through ONNX Runtime on the CPU, see export_onnx.py
+    if model_dir is not None and model_dir.endswith('.pt'):
+        print("...load torchscript", model_dir)
+        return load_scripted(model_dir)
+    if model_dir is not None and model_dir.endswith('.onnx'):
+        print("...load ONNX Runtime", model_dir)
+        return OnnxNet(model_dir)
+
+    if(model_name=='u2net'):
+        print("...load U2NET---173.6 MB")
+        net = U2NET(in_ch,1)
+    elif(model_name=='u2netp'):
+        print("...load U2NEP---4.7 MB")
+        net = U2NETP(in_ch,1)
+    else:
+        raise ValueError("unknown model_name: %s" % model_name)
+
+    if model_dir is not None:
+        net.load_state_dict(torch.load(model_dir, map_location='cpu'))
+
+    if torch.cuda.is_available():
+        net.cuda()
+
+    net.eval()
+    if fuse:
+        net = fuse_for_inference(net)
+
+    return net
+
+def input_channels(net):
+    # 3 for the plain model, 4 for the variant with a prior channel
+    if hasattr(net, 'in_ch'):
+        return net.in_ch
+    return net.stage1.rebnconvin.conv_s1.in_channels
+
+def _device(net):
+    # quantized and exported models have no float parameters and run on the CPU
+    if not isinstance(net, torch.nn.Module):
+        return torch.device('cpu')
+    param = next(net.parameters(), None)
+    return param.device if param is not None else torch.device('cpu')
+
+# normalize every predicted SOD probability map of the batch separately
+def normPRED(d):
+    ma = torch.amax(d, dim=(1,2,3), keepdim=True)
+    mi = torch.amin(d, dim=(1,2,3), keepdim=True)
+
+    dn = (d-mi)/(ma-mi)
+
+    return dn
+
+def prepare_image(image, size=(320,320)):
+    # HxW or HxWxC uint8 image -> 3xHxW float32 in [0,1], resized the same way as RescaleT
+    if(2==len(image.shape)):
+        image = np.stack((image,image,image), axis=-1)
+    image = Image.fromarray(np.uint8(image[:,:,:3]))
+    image = image.resize((size[1],size[0]), resample=Image.BILINEAR)
+
+    image = np.asarray(image, dtype=np.float32) / 255
+
+    return np.moveaxis(image, 2, 0)
+
+def prepare_prior(prior, size=(320,320)):
+    # HxW(xC) uint8 prior -> 1xHxW float32, scaled by its maximum like ToTensorLab
+    if(3==len(prior.shape)):
+        prior = prior[:,:,0]
+    prior = Image.fromarray(np.uint8(prior))
+    prior = prior.resize((size[1],size[0]), resample=Image.BILINEAR)
+
+    prior = np.asarray(prior, dtype=np.float32)
+    if(np.max(prior)>=1e-6):
+        prior = prior/np.max(prior)
+
+    return prior[np.newaxis]
+
+def prepare_batch(images, priors=None, size=(320,320), in_ch=3):
+    # stack N images (and optional priors) into one Nx in_ch xHxW input tensor
+    batch = np.zeros((len(images), in_ch, size[0], size[1]), dtype=np.float32)
+
+    for i, image in enumerate(images):
+        batch[i,:3] = prepare_image(image, size)
+        if in_ch == 4 and priors is not None and priors[i] is not None:
+            batch[i,3:] = prepare_prior(priors[i], size)
+
+    return torch.from_numpy(batch)
+
+def fused_forward(net, inputs):
+    # d0 only; U2NET/U2NETP skip the side-output sigmoids, other modules return d0 or all seven maps
+    if hasattr(net, 'forward_fused'):
+        return net.forward_fused(inputs)
+
+    d0 = net(inputs)
+    if isinstance(d0, (tuple, list)):
+        d0 = d0[0]
+
+    return d0
+
+def forward_batch(net, inputs):
+    # one forward pass over the whole batch, returns the fused output d0
+    with torch.no_grad():
+        d0 = fused_forward(net, inputs.to(_device(net)))
+
+    return d0
+
+def split_batch(d0, sizes, normalize=True):
+    # cut the batched d0 back into one HxW float32 mask per image at its original size
+    preds = []
+    for i, (height, width) in enumerate(sizes):
+        pred = d0[i:i+1]
+        if normalize:
+            pred = normPRED(pred)
+        pred = F.interpolate(pred, size=(int(height),int(width)), mode='bilinear', align_corners=False)
+        preds.append(pred[0,0].cpu().numpy())
+
+    return preds
+
+def predict_batch(net, images, priors=None, size=(320,320), normalize=True):
+    """Run U2NET/U2NETP on a list of HxWxC uint8 images in a single forward pass.
+
+    Returns one HxW float32 mask in [0,1] per image, resized back to the
+    image's original height and width.
+    """
+    inputs = prepare_batch(images, priors, size, input_channels(net))
+    d0 = forward_batch(net, inputs)
+
+    return split_batch(d0, [image.shape[:2] for image in images], normalize)
+
+def as_prior(d0):
+    # d0 of one frame -> prior channel of the next, scaled as in prepare_prior
+    ma = torch.amax(d0, dim=(1,2,3), keepdim=True)
+
+    return torch.where(ma >= 1e-6, d0 / ma.clamp(min=1e-6), d0)
+
+class PriorStream(object):
+    """Feed each frame's predicted d0 back in as the prior channel of the next frame."""
+
+    def __init__(self, net, first_prior=None):
+        self.net = net
+        self.prior = first_prior
+
+    def __call__(self, inputs):
+        if self.prior is not None:
+            inputs[:,3:] = self.prior
+        d0 = forward_batch(self.net, inputs)
+        self.prior = as_prior(d0).cpu()
+
+        return inputs, d0
+
+class FrameGate(object):
+    """Reuse the last d0 for frames whose downsampled grayscale differs from the last inferred frame by less than threshold in every cell."""
+
+    def __init__(self, threshold=0.01, size=(64,64), warp=False, block=8):
+        self.threshold = threshold
+        self.size = size
+        self.warp = warp
+        self.block = block
+
+        self.last_small = None
+        self.last_d0 = None
+
+        self.n_frames = 0
+        self.n_skipped = 0
+        self.infer_time = 0.0
+
+    def _small(self, inputs):
+        small = F.interpolate(inputs[:1,:3].float(), size=self.size, mode='area')
+        return small.mean(dim=1)[0].cpu().numpy()
+
+    def _warped(self, small):
+        (dx, dy), _ = cv2.phaseCorrelate(self.last_small, small)
+        d0 = self.last_d0[0,0].cpu().numpy()
+        dx = dx * d0.shape[1] / self.size[1]
+        dy = dy * d0.shape[0] / self.size[0]
+        M = np.float32([[1,0,dx],[0,1,dy]])
+        d0 = cv2.warpAffine(d0, M, (d0.shape[1], d0.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        return torch.from_numpy(d0)[None,None]
+
+    def _difference(self, small):
+        # largest mean absolute difference over the block x block cells
+        diff = np.abs(small - self.last_small)
+        cells = (max(1, diff.shape[1] // self.block), max(1, diff.shape[0] // self.block))
+        return float(cv2.resize(diff, cells, interpolation=cv2.INTER_AREA).max())
+
+    def __call__(self, inputs, infer):
+        # d0 of the frame, from infer(inputs) or from the last inferred frame
+        self.n_frames += 1
+        small = self._small(inputs)
+
+        if self.last_small is not None and self._difference(small) < self.threshold:
+            self.n_skipped += 1
+            if self.warp:
+                return self._warped(small)
+            return self.last_d0
+
+        start = time.perf_counter()
+        d0 = infer(inputs)
+        self.infer_time += time.perf_counter() - start
+
+        self.last_small = small
+        self.last_d0 = d0
+
+        return d0
+
+    def summary(self, elapsed):
+        # skip ratio, achieved frames/s and the frames/s the same run would get without gating
+        n_inferred = max(1, self.n_frames - self.n_skipped)
+        ungated = elapsed + self.n_skipped * self.infer_time / n_inferred
+
+        return "skipped %d/%d frames (%.1f%%), %.2f frames/s, %.2f frames/s without gating" % (
+            self.n_skipped, self.n_frames, 100.0 * self.n_skipped / max(1, self.n_frames),
+            self.n_frames / elapsed, self.n_frames / ungated)
+
+def _tile_starts(length, tile, stride):
+    # tile offsets covering [0,length), the last tile is aligned to the end
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+
+    return starts
+
+def _blend_ramp(tile, overlap, taper_start, taper_end):
+    ramp = np.ones(tile, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        if taper_start:
+            ramp[:overlap] = edge
+        if taper_end:
+            ramp[-overlap:] = edge[::-1]
+
+    return ramp
+
+def _blend_window(tile, overlap, y, x, height, width):
+    # separable ramp, 1 inside the tile and falling off over the overlap so seams blend smoothly;
+    # tile edges on the image border have no neighbour to blend with and are not tapered
+    ramp_y = _blend_ramp(tile, overlap, y > 0, y + tile < height)
+    ramp_x = _blend_ramp(tile, overlap, x > 0, x + tile < width)
+
+    return np.outer(ramp_y, ramp_x)
+
+def _prepare_full(image, prior, in_ch, scale, tile):
+    # uint8 image (+ prior) at the working resolution, reflect-padded to at least one tile
+    if(2==len(image.shape)):
+        image = np.stack((image,image,image), axis=-1)
+    image = image[:,:,:3]
+
+    if in_ch == 4 and prior is not None:
+        if(3==len(prior.shape)):
+            prior = prior[:,:,0]
+    else:
+        prior = None
+
+    if scale != 1.0:
+        size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+        image = np.asarray(Image.fromarray(np.uint8(image)).resize(size, resample=Image.BILINEAR))
+        if prior is not None:
+            prior = np.asarray(Image.fromarray(np.uint8(prior)).resize(size, resample=Image.BILINEAR))
+
+    pad_h = max(0, tile - image.shape[0])
+    pad_w = max(0, tile - image.shape[1])
+    if pad_h or pad_w:
+        image = np.pad(image, ((0,pad_h),(0,pad_w),(0,0)), mode='reflect')
+        if prior is not None:
+            prior = np.pad(prior, ((0,pad_h),(0,pad_w)), mode='reflect')
+
+    return image, prior, (pad_h, pad_w)
+
+def _run_tiles(net, image, prior, positions, tile, overlap, batch_size, mask_sum, weight_sum):
+    # forward the tiles at `positions` batch_size at a time and blend them into the accumulators
+    in_ch = input_channels(net)
+    if prior is not None:
+        # same prior scaling as prepare_prior
+        prior_max = np.float32(max(float(np.max(prior)), 1e-6))
+
+    for i_batch in range(0, len(positions), batch_size):
+        batch_positions = positions[i_batch:i_batch+batch_size]
+
+        inputs = np.zeros((len(batch_positions), in_ch, tile, tile), dtype=np.float32)
+        for i, (y, x) in enumerate(batch_positions):
+            inputs[i,:3] = np.moveaxis(image[y:y+tile,x:x+tile], 2, 0) / np.float32(255)
+            if prior is not None:
+                inputs[i,3] = prior[y:y+tile,x:x+tile] / prior_max
+
+        d0 = forward_batch(net, torch.from_numpy(inputs)).cpu().numpy()
+
+        for i, (y, x) in enumerate(batch_positions):
+            window = _blend_window(tile, overlap, y, x, image.shape[0], image.shape[1])
+            mask_sum[y:y+tile,x:x+tile] += d0[i,0] * window
+            weight_sum[y:y+tile,x:x+tile] += window
+
+def _to_original(mask, padding, height, width):
+    mask = mask[:mask.shape[0]-padding[0],:mask.shape[1]-padding[1]]
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    return mask
+
+def predict_tiled(net, image, prior=None, tile=320, overlap=64, batch_size=8, scale=1.0):
+    """Full-resolution HxW mask blended from overlapping tile x tile crops run at the model's native input size."""
+    height, width = image.shape[:2]
+    image, prior, padding = _prepare_full(image, prior, input_channels(net), scale, tile)
+
+    work_h, work_w = image.shape[:2]
+    stride = tile - overlap
+    positions = [(y, x) for y in _tile_starts(work_h, tile, stride) for x in _tile_starts(work_w, tile, stride)]
+
+    mask_sum = np.zeros((work_h, work_w), dtype=np.float32)
+    weight_sum = np.zeros((work_h, work_w), dtype=np.float32)
+    _run_tiles(net, image, prior, positions, tile, overlap, batch_size, mask_sum, weight_sum)
+
+    return _to_original(mask_sum / weight_sum, padding, height, width)
+
+def predict_refined(net, image, prior=None, size=(320,320), tile=320, overlap=32, band=(0.05,0.95), margin=8, batch_size=8, scale=1.0):
+    """Coarse mask from one low-resolution pass, refined at full resolution on the uncertain edge band only."""
+    height, width = image.shape[:2]
+    in_ch = input_channels(net)
+
+    coarse = predict_batch(net, [image], [prior], size, normalize=False)[0]
+    if in_ch == 4 and prior is None:
+        prior = np.uint8(coarse * 255)
+
+    image, prior, padding = _prepare_full(image, prior, in_ch, scale, tile)
+    work_h, work_w = image.shape[:2]
+
+    coarse = cv2.resize(coarse, (work_w - padding[1], work_h - padding[0]), interpolation=cv2.INTER_LINEAR)
+    coarse = np.pad(coarse, ((0,padding[0]),(0,padding[1])), mode='reflect')
+
+    uncertain = (coarse > band[0]) & (coarse < band[1])
+    stride = tile - overlap
+    positions = [(y, x) for y in _tile_starts(work_h, tile, stride) for x in _tile_starts(work_w, tile, stride)
+                 if uncertain[y:y+tile,x:x+tile].any()]
+
+    mask_sum = np.zeros((work_h, work_w), dtype=np.float32)
+    weight_sum = np.zeros((work_h, work_w), dtype=np.float32)
+    _run_tiles(net, image, prior, positions, tile, overlap, batch_size, mask_sum, weight_sum)
+
+    # the patches lack global context, only take them on the edge band; weight_sum also falls to 0
+    # where a refined tile borders an unrefined one
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (4 * margin + 1, 4 * margin + 1))
+    edge_band = cv2.dilate(np.uint8(uncertain), kernel).astype(np.float32)
+    edge_band = cv2.blur(edge_band, (2 * margin + 1, 2 * margin + 1))
+    alpha = np.minimum(weight_sum, 1) * edge_band
+    refined = mask_sum / np.maximum(weight_sum, 1e-6)
+    mask = coarse + alpha * (refined - coarse)
+
+    return _to_original(mask, padding, height, width)
+
+def benchmark_batch_sizes(net, batch_sizes=(1,2,4,8,16,32), size=(320,320), n_images=64, warmup=2):
+    # model throughput in images/s for every batch size, on random inputs
+    in_ch = input_channels(net)
+    results = []
+
+    for batch_size in batch_sizes:
+        inputs = torch.rand(batch_size, in_ch, size[0], size[1])
+        for _ in range(warmup):
+            forward_batch(net, inputs)
+
+        n_batches = max(1, n_images // batch_size)
+        start = time.perf_counter()
+        for _ in range(n_batches):
+            forward_batch(net, inputs)
+        elapsed = time.perf_counter() - start
+
+        results.append((batch_size, n_batches * batch_size / elapsed))
+
+    return results
+
+def benchmark_fused(net, batch_size=1, size=(320,320), n_iters=20, warmup=2):
+    # seconds per image of forward() against forward_fused(), and the max |d0| difference
+    inputs = torch.rand(batch_size, input_channels(net), size[0], size[1]).to(_device(net))
+
+    with torch.no_grad():
+        max_diff = torch.max(torch.abs(net(inputs)[0] - net.forward_fused(inputs))).item()
+
+        timings = []
+        for forward in (lambda x: net(x), net.forward_fused):
+            for _ in range(warmup):
+                forward(inputs)
+            start = time.perf_counter()
+            for _ in range(n_iters):
+                forward(inputs)
+            timings.append((time.perf_counter() - start) / (n_iters * batch_size))
+
+    return timings[0], timings[1], max_diff
+
+def benchmark_fusion(net, fused_net, batch_size=1, size=(320,320), n_iters=20, warmup=2):
+    # seconds per image of the unfused and the conv+bn folded model, and the max |d0| difference
+    inputs = torch.rand(batch_size, input_channels(net), size[0], size[1]).to(_device(net))
+
+    timings = []
+    with torch.no_grad():
+        max_diff = torch.max(torch.abs(fused_forward(net, inputs) - fused_forward(fused_net, inputs))).item()
+
+        for model in (net, fused_net):
+            for _ in range(warmup):
+                fused_forward(model, inputs)
+            start = time.perf_counter()
+            for _ in range(n_iters):
+                fused_forward(model, inputs)
+            timings.append((time.perf_counter() - start) / (n_iters * batch_size))
+
+    return timings[0], timings[1], max_diff
+
+def benchmark_backends(nets, batch_size=1, size=(320,320), n_iters=20, warmup=2):
+    # seconds per image of every backend and its max |d0| difference to the first one
+    inputs = torch.rand(batch_size, input_channels(nets[0]), size[0], size[1])
+
+    reference = forward_batch(nets[0], inputs).cpu()
+    results = []
+    for net in nets:
+        max_diff = torch.max(torch.abs(forward_batch(net, inputs).cpu() - reference)).item()
+
+        for _ in range(warmup):
+            forward_batch(net, inputs)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            forward_batch(net, inputs)
+        results.append(((time.perf_counter() - start) / (n_iters * batch_size), max_diff))
+
+    return results
@@ -1,2 +1,6 @@
 from .u2net import U2NET
 from .u2net import U2NETP
+from .u2net import FusedOutput
+from .u2net import fuse_for_inference
+from .u2net import LogitsOutput
+from .u2net import set_activation_checkpointing
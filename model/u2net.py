@@ -2,6 +2,10 @@ import torch
 import torch.nn as nn
 from torchvision import models
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
+import contextlib
+import copy
 
 class REBNCONV(nn.Module):
     def __init__(self,in_ch=3,out_ch=3,dirate=1):
@@ -18,6 +22,66 @@ class REBNCONV(nn.Module):
 
         return xout
 
+    def fuse(self):
+        # fold bn_s1 into conv_s1 with the running statistics, only valid in eval mode
+        self.conv_s1 = fuse_conv_bn_eval(self.conv_s1,self.bn_s1)
+        self.bn_s1 = nn.Identity()
+
+## copy of U2NET / U2NETP with every REBNCONV batchnorm folded into its conv, for inference only
+def fuse_for_inference(net):
+
+    net = copy.deepcopy(net).eval()
+    for m in net.modules():
+        if isinstance(m,REBNCONV):
+            m.fuse()
+
+    return net
+
+## activation checkpointing of the encoder/decoder stages (RSU blocks)
+STAGE_GROUPS = {
+    'none': [],
+    'encoder': ['stage1','stage2','stage3','stage4','stage5','stage6'],
+    'decoder': ['stage5d','stage4d','stage3d','stage2d','stage1d'],
+    # the full and half resolution blocks, which hold most of the activations
+    'high-res': ['stage1','stage2','stage2d','stage1d'],
+}
+STAGE_GROUPS['all'] = STAGE_GROUPS['encoder'] + STAGE_GROUPS['decoder']
+
+def set_activation_checkpointing(net,stages='all'):
+    """Recompute the selected stages (a STAGE_GROUPS key or stage names) in backward instead of keeping their intermediates."""
+    names = STAGE_GROUPS[stages] if isinstance(stages,str) else list(stages)
+    for name in STAGE_GROUPS['all']:
+        getattr(net,name).activation_checkpoint = name in names
+    return net
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # the recomputation must not update the BatchNorm running statistics a second time
+    bns = [m for m in module.modules() if isinstance(m,nn.modules.batchnorm._BatchNorm)]
+    momenta = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn,momentum in zip(bns,momenta):
+            bn.momentum = momentum
+
+def _run_stage(stage,x):
+
+    if not (getattr(stage,'activation_checkpoint',False) and stage.training and torch.is_grad_enabled()):
+        return stage(x)
+
+    calls = []
+    def run(x):
+        calls.append(None)
+        if len(calls) == 1:
+            return stage(x)
+        with _frozen_bn_stats(stage):
+            return stage(x)
+
+    return checkpoint(run,x,use_reentrant=False)
+
 ## upsample tensor 'src' to have the same spatial size with tensor 'tar'
 def _upsample_like(src,tar):
 
@@ -25,6 +89,22 @@ def _upsample_like(src,tar):
 
     return src
 
+## fused output d0 of U2NET / U2NETP from the decoder features [hx1d,hx2d,hx3d,hx4d,hx5d,hx6]
+## every feature map and side output is released as soon as it has been used
+def _fused_output(net,features):
+
+    d1 = net.side1(features.pop(0))
+
+    sides = [d1]
+    for side in (net.side2,net.side3,net.side4,net.side5,net.side6):
+        sides.append(_upsample_like(side(features.pop(0)),d1))
+    del d1
+
+    d0 = net.outconv(torch.cat(sides,1))
+    del sides
+
+    return F.sigmoid(d0)
+
 
 ### RSU-7 ###
 class RSU7(nn.Module):#UNet07DRES(nn.Module):
@@ -354,49 +434,54 @@ class U2NET(nn.Module):
 
         self.outconv = nn.Conv2d(6,out_ch,1)
 
-    def forward(self,x):
+    def _decode(self,x):
 
         hx = x
 
         #stage 1
-        hx1 = self.stage1(hx)
+        hx1 = _run_stage(self.stage1,hx)
         hx = self.pool12(hx1)
 
         #stage 2
-        hx2 = self.stage2(hx)
+        hx2 = _run_stage(self.stage2,hx)
         hx = self.pool23(hx2)
 
         #stage 3
-        hx3 = self.stage3(hx)
+        hx3 = _run_stage(self.stage3,hx)
         hx = self.pool34(hx3)
 
         #stage 4
-        hx4 = self.stage4(hx)
+        hx4 = _run_stage(self.stage4,hx)
         hx = self.pool45(hx4)
 
         #stage 5
-        hx5 = self.stage5(hx)
+        hx5 = _run_stage(self.stage5,hx)
         hx = self.pool56(hx5)
 
         #stage 6
-        hx6 = self.stage6(hx)
+        hx6 = _run_stage(self.stage6,hx)
         hx6up = _upsample_like(hx6,hx5)
 
         #-------------------- decoder --------------------
-        hx5d = self.stage5d(torch.cat((hx6up,hx5),1))
+        hx5d = _run_stage(self.stage5d,torch.cat((hx6up,hx5),1))
         hx5dup = _upsample_like(hx5d,hx4)
 
-        hx4d = self.stage4d(torch.cat((hx5dup,hx4),1))
+        hx4d = _run_stage(self.stage4d,torch.cat((hx5dup,hx4),1))
         hx4dup = _upsample_like(hx4d,hx3)
 
-        hx3d = self.stage3d(torch.cat((hx4dup,hx3),1))
+        hx3d = _run_stage(self.stage3d,torch.cat((hx4dup,hx3),1))
         hx3dup = _upsample_like(hx3d,hx2)
 
-        hx2d = self.stage2d(torch.cat((hx3dup,hx2),1))
+        hx2d = _run_stage(self.stage2d,torch.cat((hx3dup,hx2),1))
         hx2dup = _upsample_like(hx2d,hx1)
 
-        hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
+        hx1d = _run_stage(self.stage1d,torch.cat((hx2dup,hx1),1))
+
+        return hx1d, hx2d, hx3d, hx4d, hx5d, hx6
 
+    def forward_logits(self,x):
+        # training: d0..d6 before the sigmoid, for BCE-with-logits losses and autocast
+        hx1d, hx2d, hx3d, hx4d, hx5d, hx6 = self._decode(x)
 
         #side output
         d1 = self.side1(hx1d)
@@ -418,8 +503,18 @@ class U2NET(nn.Module):
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))
 
+        return d0, d1, d2, d3, d4, d5, d6
+
+    def forward(self,x):
+
+        d0, d1, d2, d3, d4, d5, d6 = self.forward_logits(x)
+
         return F.sigmoid(d0), F.sigmoid(d1), F.sigmoid(d2), F.sigmoid(d3), F.sigmoid(d4), F.sigmoid(d5), F.sigmoid(d6)
 
+    def forward_fused(self,x):
+        # inference only: same d0 as forward, without sigmoids on or references to the side outputs
+        return _fused_output(self, list(self._decode(x)))
+
 ### U^2-Net small ###
 class U2NETP(nn.Module):
 
@@ -459,49 +554,54 @@ class U2NETP(nn.Module):
 
         self.outconv = nn.Conv2d(6,out_ch,1)
 
-    def forward(self,x):
+    def _decode(self,x):
 
         hx = x
 
         #stage 1
-        hx1 = self.stage1(hx)
+        hx1 = _run_stage(self.stage1,hx)
         hx = self.pool12(hx1)
 
         #stage 2
-        hx2 = self.stage2(hx)
+        hx2 = _run_stage(self.stage2,hx)
         hx = self.pool23(hx2)
 
         #stage 3
-        hx3 = self.stage3(hx)
+        hx3 = _run_stage(self.stage3,hx)
         hx = self.pool34(hx3)
 
         #stage 4
-        hx4 = self.stage4(hx)
+        hx4 = _run_stage(self.stage4,hx)
         hx = self.pool45(hx4)
 
         #stage 5
-        hx5 = self.stage5(hx)
+        hx5 = _run_stage(self.stage5,hx)
         hx = self.pool56(hx5)
 
         #stage 6
-        hx6 = self.stage6(hx)
+        hx6 = _run_stage(self.stage6,hx)
         hx6up = _upsample_like(hx6,hx5)
 
         #decoder
-        hx5d = self.stage5d(torch.cat((hx6up,hx5),1))
+        hx5d = _run_stage(self.stage5d,torch.cat((hx6up,hx5),1))
         hx5dup = _upsample_like(hx5d,hx4)
 
-        hx4d = self.stage4d(torch.cat((hx5dup,hx4),1))
+        hx4d = _run_stage(self.stage4d,torch.cat((hx5dup,hx4),1))
         hx4dup = _upsample_like(hx4d,hx3)
 
-        hx3d = self.stage3d(torch.cat((hx4dup,hx3),1))
+        hx3d = _run_stage(self.stage3d,torch.cat((hx4dup,hx3),1))
         hx3dup = _upsample_like(hx3d,hx2)
 
-        hx2d = self.stage2d(torch.cat((hx3dup,hx2),1))
+        hx2d = _run_stage(self.stage2d,torch.cat((hx3dup,hx2),1))
         hx2dup = _upsample_like(hx2d,hx1)
 
-        hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
+        hx1d = _run_stage(self.stage1d,torch.cat((hx2dup,hx1),1))
 
+        return hx1d, hx2d, hx3d, hx4d, hx5d, hx6
+
+    def forward_logits(self,x):
+        # training: d0..d6 before the sigmoid, for BCE-with-logits losses and autocast
+        hx1d, hx2d, hx3d, hx4d, hx5d, hx6 = self._decode(x)
 
         #side output
         d1 = self.side1(hx1d)
@@ -523,4 +623,38 @@ class U2NETP(nn.Module):
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))
 
+        return d0, d1, d2, d3, d4, d5, d6
+
+    def forward(self,x):
+
+        d0, d1, d2, d3, d4, d5, d6 = self.forward_logits(x)
+
         return F.sigmoid(d0), F.sigmoid(d1), F.sigmoid(d2), F.sigmoid(d3), F.sigmoid(d4), F.sigmoid(d5), F.sigmoid(d6)
+
+    def forward_fused(self,x):
+        # inference only: same d0 as forward, without sigmoids on or references to the side outputs
+        return _fused_output(self, list(self._decode(x)))
+
+### fused-output-only wrapper, e.g. for tracing or export ###
+class FusedOutput(nn.Module):
+
+    def __init__(self,net):
+        super(FusedOutput,self).__init__()
+
+        self.net = net
+
+    def forward(self,x):
+
+        return self.net.forward_fused(x)
+
+### logits wrapper for training, so DistributedDataParallel sees forward_logits as forward ###
+class LogitsOutput(nn.Module):
+
+    def __init__(self,net):
+        super(LogitsOutput,self).__init__()
+
+        self.net = net
+
+    def forward(self,x):
+
+        return self.net.forward_logits(x)
@@ -0,0 +1,44 @@
+# background writer pool for inference outputs
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+
+class OutputSink(object):
+    """Bounded thread pool that composites, encodes and writes results off the model loop; close() re-raises job errors."""
+
+    def __init__(self, num_workers=4, max_pending=16):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def _raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, fn, *args):
+        self._raise_errors()
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+
+    def imwrite(self, path, image):
+        self.submit(cv2.imwrite, path, image)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+        if exc_type is None:
+            self._raise_errors()
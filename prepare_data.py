@@ -0,0 +1,47 @@
+# one-time conversions of the PNG training folders into faster training formats
+#
+#   python prepare_data.py cache --image-dir train_data/FINAL5.1_combined/ \
+#       --label-dir train_data/FINAL5.1_MATTE/ --prior-dir train_data/FINAL5.1_MATTE_predicted_1/ \
+#       --output train_data/FINAL5.1_320.npy
+#
+#   python prepare_data.py shards ... --output train_data/FINAL5.1_shards
+import argparse
+
+from data_loader import salobj_name_lists
+from data_loader import build_salobj_cache
+from data_loader import write_salobj_shards
+
+
+def prepare_cache(args):
+    img_name_list, lbl_name_list, pri_name_list = salobj_name_lists(args.image_dir, args.label_dir, args.prior_dir)
+    build_salobj_cache(img_name_list, lbl_name_list, pri_name_list, args.output, (args.size,args.size), args.num_workers)
+    print("saved", args.output)
+
+def prepare_shards(args):
+    img_name_list, lbl_name_list, pri_name_list = salobj_name_lists(args.image_dir, args.label_dir, args.prior_dir)
+    write_salobj_shards(img_name_list, lbl_name_list, pri_name_list, args.output, args.samples_per_shard)
+    print("saved", args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description="convert the training data")
+    parser.add_argument('--image-dir', required=True, help="with trailing separator, like u2net_train.py")
+    parser.add_argument('--label-dir', required=True)
+    parser.add_argument('--prior-dir', required=True)
+    parser.add_argument('--num-workers', type=int, default=4)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('cache', help="memory-mapped uint8 cache, pre-resized, see CachedSalObjDataset")
+    p.add_argument('--output', required=True, help=".npy path, the index goes next to it as .npy.json")
+    p.add_argument('--size', type=int, default=320)
+    p.set_defaults(func=prepare_cache)
+
+    p = subparsers.add_parser('shards', help="tar shards with image, label and prior per sample, see ShardedSalObjDataset")
+    p.add_argument('--output', required=True, help="shard directory")
+    p.add_argument('--samples-per-shard', type=int, default=1000)
+    p.set_defaults(func=prepare_shards)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# static INT8 post-training quantization of U2NETP for the CPU inference nodes
+#
+#   python quantize.py --weights saved_models/u2netp/Best1_320px.pth --in-ch 4 \
+#       --calib-images train_data/FINAL5.1_combined --calib-priors train_data/FINAL5.1_MATTE_predicted_1 \
+#       --eval-images test_data/holdout --eval-priors test_data/holdout_prior \
+#       --output saved_models/u2netp/Best1_320px_int8.pt
+#
+# The written .pt is torchscript and returns d0 only; load_net() loads it in place of
+# the fp32 .pth when model_dir ends with .pt.
+import argparse
+import copy
+import glob
+import io
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from data_loader import RescaleT
+from data_loader import ToTensorLab
+from data_loader import SalObjDataset
+from model import FusedOutput
+from inference import load_net
+from inference import load_scripted
+from inference import save_scripted
+from inference import forward_batch
+
+
+def salobj_loader(image_dir, prior_dir=None, n_images=None, batch_size=8, size=(320,320)):
+    # images (+ priors with the same file name) through the usual RescaleT/ToTensorLab pipeline
+    img_name_list = sorted(glob.glob(image_dir + os.sep + '*'))
+    if n_images is not None and n_images < len(img_name_list):
+        # spread the calibration images over the whole folder
+        step = len(img_name_list) / float(n_images)
+        img_name_list = [img_name_list[int(i * step)] for i in range(n_images)]
+
+    pri_name_list = []
+    if prior_dir is not None:
+        for img_path in img_name_list:
+            imidx = os.path.splitext(os.path.basename(img_path))[0]
+            pri_name_list.append(os.path.join(prior_dir, imidx + '.png'))
+
+    dataset = SalObjDataset(img_name_list=img_name_list,
+                            lbl_name_list=[],
+                            pri_name_list=pri_name_list,
+                            transform=transforms.Compose([RescaleT(size), ToTensorLab(flag=0)]))
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=2)
+
+def quantize_u2netp(net, calib_loader, in_ch, size=(320,320), backend='fbgemm'):
+    """Calibrate and convert the fused-output U2NETP to INT8 with FX graph mode.
+
+    FX tracing sees the torch.cat skip connections, the residual adds and the
+    bilinear _upsample_like calls as graph nodes and swaps them for their
+    quantized kernels, so the model code stays untouched. Conv+BN+ReLU of
+    every REBNCONV is fused during prepare_fx.
+    """
+    torch.backends.quantized.engine = backend
+
+    # prepare_fx shares submodules with its input, keep the fp32 net intact for the comparison
+    model = FusedOutput(copy.deepcopy(net)).cpu().eval()
+    example_inputs = (torch.rand(1, in_ch, size[0], size[1]),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+
+    with torch.no_grad():
+        for i, data in enumerate(calib_loader):
+            prepared(data['image'][:,:in_ch].type(torch.FloatTensor))
+            print("calibrated %d images" % ((i + 1) * data['image'].shape[0]))
+
+    return convert_fx(prepared)
+
+def state_dict_size(net):
+    buffer = io.BytesIO()
+    torch.save(net.state_dict(), buffer)
+    return buffer.tell()
+
+def compare(fp32_net, int8_net, eval_loader, in_ch):
+    # mean absolute error of the INT8 d0 against fp32, and seconds per image for both
+    abs_error = 0.0
+    n_pixels = 0
+    n_images = 0
+    fp32_time = 0.0
+    int8_time = 0.0
+
+    for data in eval_loader:
+        inputs = data['image'][:,:in_ch].type(torch.FloatTensor)
+
+        start = time.perf_counter()
+        d0_fp32 = forward_batch(fp32_net, inputs).cpu()
+        fp32_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        d0_int8 = forward_batch(int8_net, inputs)
+        int8_time += time.perf_counter() - start
+
+        abs_error += torch.sum(torch.abs(d0_fp32 - d0_int8)).item()
+        n_pixels += d0_fp32.numel()
+        n_images += inputs.shape[0]
+
+    return abs_error / n_pixels, fp32_time / n_images, int8_time / n_images
+
+def main():
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization of U2NETP")
+    parser.add_argument('--weights', required=True, help="fp32 U2NETP state_dict .pth")
+    parser.add_argument('--in-ch', type=int, default=4, choices=[3,4])
+    parser.add_argument('--calib-images', required=True)
+    parser.add_argument('--calib-priors', default=None)
+    parser.add_argument('--n-calib', type=int, default=300)
+    parser.add_argument('--eval-images', default=None, help="held-out folder for latency and MAE")
+    parser.add_argument('--eval-priors', default=None)
+    parser.add_argument('--output', required=True, help="torchscript .pt path")
+    parser.add_argument('--backend', default='fbgemm', choices=['fbgemm','x86','qnnpack'])
+    args = parser.parse_args()
+
+    net = load_net('u2netp', args.weights, args.in_ch)
+    net.cpu()
+
+    calib_loader = salobj_loader(args.calib_images, args.calib_priors, args.n_calib)
+    int8_net = quantize_u2netp(net, calib_loader, args.in_ch, backend=args.backend)
+
+    save_scripted(int8_net, torch.rand(1, args.in_ch, 320, 320), args.output)
+    print("saved", args.output)
+
+    print("model size: fp32 %.2f MB, int8 %.2f MB" % (state_dict_size(net) / 2**20, os.path.getsize(args.output) / 2**20))
+
+    if args.eval_images is not None:
+        eval_loader = salobj_loader(args.eval_images, args.eval_priors, batch_size=1)
+        mae, fp32_time, int8_time = compare(net, load_scripted(args.output), eval_loader, args.in_ch)
+        print("latency: fp32 %.2f ms/image, int8 %.2f ms/image" % (fp32_time * 1000, int8_time * 1000))
+        print("MAE int8 vs fp32 d0: %.5f" % mae)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# losses and training-step helpers shared by u2net_train.py and benchmark.py
+import csv
+import json
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data.distributed import DistributedSampler
+
+bce_loss = nn.BCELoss(size_average=True)
+
+def muti_bce_loss_fusion(d0, d1, d2, d3, d4, d5, d6, labels_v, verbose=False):
+
+    loss0 = bce_loss(d0,labels_v)
+    loss1 = bce_loss(d1,labels_v)
+    loss2 = bce_loss(d2,labels_v)
+    loss3 = bce_loss(d3,labels_v)
+    loss4 = bce_loss(d4,labels_v)
+    loss5 = bce_loss(d5,labels_v)
+    loss6 = bce_loss(d6,labels_v)
+
+    loss = loss0 + loss1 + loss2 + loss3 + loss4 + loss5 + loss6
+    if verbose:
+        print("l0: %3f, l1: %3f, l2: %3f, l3: %3f, l4: %3f, l5: %3f, l6: %3f\n"%(loss0.data,loss1.data,loss2.data,loss3.data,loss4.data,loss5.data,loss6.data))
+
+    return loss0, loss
+
+def multi_bce_with_logits_loss(logits, labels_v):
+    """muti_bce_loss_fusion on the stacked [7,B,1,H,W] logits of forward_logits, computed in float32."""
+    losses = F.binary_cross_entropy_with_logits(logits.float(), labels_v.expand_as(logits), reduction='none')
+    losses = losses.mean(dim=(1,2,3,4))
+
+    return losses[0], losses.sum()
+
+def forward_loss(net, inputs_v, labels_v, loss_mode='logits', bf16=False):
+    """Training forward and loss; returns (outputs, loss of d0, total loss)."""
+    if loss_mode == 'sigmoid':
+        if bf16:
+            raise ValueError("bfloat16 autocast needs loss_mode='logits', BCELoss on probabilities is not autocast-safe")
+        outputs = net(inputs_v)
+        loss0, loss = muti_bce_loss_fusion(*outputs, labels_v)
+        return outputs, loss0, loss
+
+    device_type = 'cuda' if inputs_v.is_cuda else 'cpu'
+    with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=bf16):
+        outputs = torch.stack(net(inputs_v))
+    loss0, loss = multi_bce_with_logits_loss(outputs, labels_v)
+
+    return outputs, loss0, loss
+
+def output_probability(outputs, loss_mode='logits'):
+    # d0 as a float32 sigmoid map, from either kind of forward_loss outputs
+    if loss_mode == 'sigmoid':
+        return outputs[0]
+    return torch.sigmoid(outputs[0].float())
+
+def scheduled_size(schedule, epoch):
+    # training size of the last (first epoch, size) step of schedule that has started
+    size = schedule[0][1]
+    for first_epoch, step_size in schedule:
+        if epoch >= first_epoch:
+            size = step_size
+    return size
+
+def scaled_batch_size(batch_size, size, reference_size=320):
+    # batch size with the pixels per step of batch_size at reference_size
+    return max(1, int(round(batch_size * (reference_size / size) ** 2)))
+
+class TrainMetrics(object):
+    """Loss, samples/s and data-wait vs compute time, summed on-device and logged every log_every steps."""
+
+    fields = ['epoch', 'ite', 'loss', 'tar', 'samples_per_s', 'data_ms', 'compute_ms', 'data_fraction']
+
+    def __init__(self, log_every=100, log_path=None, world_size=1):
+        self.log_every = log_every
+        self.world_size = world_size
+        self.log_path = log_path
+        self.log_file = None
+        self.csv_writer = None
+        if log_path is not None:
+            self.log_file = open(log_path, 'a')
+            if log_path.endswith('.csv'):
+                self.csv_writer = csv.DictWriter(self.log_file, fieldnames=self.fields)
+                if self.log_file.tell() == 0:
+                    self.csv_writer.writeheader()
+
+        self._last = time.perf_counter()
+        self._reset()
+
+    def _reset(self):
+        self.loss_sum = 0.0
+        self.tar_sum = 0.0
+        self.steps = 0
+        self.samples = 0
+        self.data_time = 0.0
+        self.compute_time = 0.0
+
+    # data_ready() when the DataLoader hands over a batch, step() after optimizer.step()
+    def data_ready(self):
+        now = time.perf_counter()
+        self.data_time += now - self._last
+        self._last = now
+
+    def step(self, loss, tar_loss, batch_size, epoch, ite):
+        # returns the logged record every log_every steps, None otherwise
+        self.loss_sum = self.loss_sum + loss.detach()
+        self.tar_sum = self.tar_sum + tar_loss.detach()
+        self.steps += 1
+        self.samples += batch_size * self.world_size
+
+        now = time.perf_counter()
+        self.compute_time += now - self._last
+        self._last = now
+
+        if self.steps == self.log_every:
+            return self.log(epoch, ite)
+        return None
+
+    def log(self, epoch, ite):
+        if self.steps == 0:
+            return None
+
+        elapsed = self.data_time + self.compute_time
+        record = {
+            'epoch': epoch,
+            'ite': ite,
+            'loss': float(self.loss_sum) / self.steps,
+            'tar': float(self.tar_sum) / self.steps,
+            'samples_per_s': self.samples / elapsed,
+            'data_ms': self.data_time * 1000 / self.steps,
+            'compute_ms': self.compute_time * 1000 / self.steps,
+            'data_fraction': self.data_time / elapsed,
+        }
+        print("[epoch: %3d, ite: %d] train loss: %3f, tar: %3f, %.1f samples/s, data %.1f ms + compute %.1f ms per step (%.0f%% data)" % (
+            epoch, ite, record['loss'], record['tar'], record['samples_per_s'], record['data_ms'], record['compute_ms'], record['data_fraction'] * 100))
+
+        # CSV when log_path ends with .csv, JSON lines otherwise
+        if self.log_file is not None:
+            if self.csv_writer is not None:
+                self.csv_writer.writerow(record)
+            else:
+                self.log_file.write(json.dumps(record) + '\n')
+            self.log_file.flush()
+
+        self._reset()
+        return record
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler whose (seed, epoch) permutation can resume mid-epoch via resume(epoch, position)."""
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start = 0
+
+    def resume(self, epoch, position):
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start = position
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def cpu_copy(obj):
+    # detached CPU copy of a (nested) state dict, safe to serialize while training continues
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, cpu_copy(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(value) for value in obj)
+    return obj
+
+def training_checkpoint(net, optimizer, ite_num, epoch, position):
+    """Snapshot of everything needed to resume: weights, Adam state, iteration,
+    epoch, samples already consumed in that epoch and the RNG states."""
+    return {
+        'model': cpu_copy(net.state_dict()),
+        'optimizer': cpu_copy(optimizer.state_dict()),
+        'ite_num': ite_num,
+        'epoch': epoch,
+        'position': position,
+        'rng': rng_state(),
+    }
+
+def save_atomic(obj, path):
+    # readers never see a partially written file, a crash leaves the previous one in place
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_training_checkpoint(path, net, optimizer):
+    # restores weights, optimizer and RNG; returns (ite_num, epoch, position)
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    net.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    set_rng_state(checkpoint['rng'])
+
+    return checkpoint['ite_num'], checkpoint['epoch'], checkpoint['position']
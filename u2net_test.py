@@ -13,35 +13,21 @@ import numpy as np
 from PIL import Image
 import glob
 
-from data_loader import RescaleT
-from data_loader import ToTensor
-from data_loader import ToTensorLab
-from data_loader import SalObjDataset
+from data_loader import InferenceDataset
+from data_loader import inference_collate
 
-from model import U2NET # full size version 173.6 MB
-from model import U2NETP # small version u2net 4.7 MB
-
-# normalize the predicted SOD probability map
-def normPRED(d):
-    ma = torch.max(d)
-    mi = torch.min(d)
-
-    dn = (d-mi)/(ma-mi)
-
-    return dn
+from inference import load_net
+from inference import forward_batch
+from inference import split_batch
+from inference import predict_tiled
+from inference import predict_refined
+from output_sink import OutputSink
 
 def save_output(image_name,pred,d_dir):
 
-    predict = pred
-    predict = predict.squeeze()
-    predict_np = predict.cpu().data.numpy()
-
-    im = Image.fromarray(predict_np*255).convert('RGB')
+    # pred is already resized to the original image size by split_batch
+    im = Image.fromarray(np.uint8(pred*255)).convert('RGB')
     img_name = image_name.split(os.sep)[-1]
-    image = io.imread(image_name)
-    imo = im.resize((image.shape[1],image.shape[0]),resample=Image.BILINEAR)
-
-    pb_np = np.array(imo)
 
     aaa = img_name.split(".")
     bbb = aaa[0:-1]
@@ -49,7 +35,7 @@ def save_output(image_name,pred,d_dir):
     for i in range(1,len(bbb)):
         imidx = imidx + "." + bbb[i]
 
-    imo.save(d_dir+imidx+'.png')
+    im.save(d_dir+imidx+'.png')
 
 def main():
 
@@ -64,65 +50,53 @@ def main():
 
     prediction_dir = os.path.join(os.getcwd(), 'test_data', model_name + '_results' + os.sep)
 
-    img_name_list = glob.glob(image_dir + os.sep + '*')
+    # images per forward pass, see `python benchmark.py batch` for the throughput per batch size
+    batch_size = 8
+
+    # full-resolution masks instead of one 320x320 pass per image:
+    # 'tiled' runs overlapping 320px tiles over the whole image,
+    # 'refined' runs them only on the uncertain band around the 320px mask outline
+    full_resolution = None # None, 'tiled' or 'refined'
+
+    img_name_list = sorted(glob.glob(image_dir + os.sep + '*'))
     print(img_name_list)
 
     # --------- 2. dataloader ---------
-    #1. dataloader
-    test_salobj_dataset = SalObjDataset(img_name_list = img_name_list,
-                                        lbl_name_list = [],
-                                        transform=transforms.Compose([
-                                                                    RescaleT((320,320)),
-                                                                    ToTensorLab(flag=0)])
-                                        )
-    test_salobj_dataloader = DataLoader(test_salobj_dataset,
-                                        batch_size=1,
-                                        shuffle=False,
-                                        num_workers=1)
+    # every file is decoded once, the original pixels are only kept for the full-resolution modes
+    test_dataset = InferenceDataset(img_name_list, output_size=(320,320), keep_original=full_resolution is not None)
+    test_dataloader = DataLoader(test_dataset,
+                                 batch_size=batch_size,
+                                 shuffle=False,
+                                 num_workers=2,
+                                 collate_fn=inference_collate)
 
     # --------- 3. model define ---------
-    if(model_name=='u2net'):
-        print("...load U2NET---173.6 MB")
-        net = U2NET(3,1)
-        net.load_state_dict(torch.load(model_dir))
-
-    elif(model_name=='u2netp'):
-        print("...load U2NEP---4.7 MB")
-        net = U2NETP(3,1)
-        net.load_state_dict(torch.load(model_dir))
-
-    if torch.cuda.is_available():
-        net.cuda()
-    
-    net.eval()
+    net = load_net(model_name, model_dir, in_ch=3, fuse=True)
 
-    # net = net.load_state_dict(torch.load(model_dir))
+    # --------- 4. batched inference ---------
+    if not os.path.exists(prediction_dir):
+        os.makedirs(prediction_dir, exist_ok=True)
 
-    # --------- 4. inference for each image ---------
-    for i_test, data_test in enumerate(test_salobj_dataloader):
+    sink = OutputSink(num_workers=4, max_pending=2*batch_size)
 
-        print("inferencing:",img_name_list[i_test].split(os.sep)[-1])
+    for data_test in test_dataloader:
 
-        inputs_test = data_test['image']
-        inputs_test = inputs_test.type(torch.FloatTensor)
+        for image_name in data_test['name']:
+            print("inferencing:",image_name.split(os.sep)[-1])
 
-        if torch.cuda.is_available():
-            inputs_test = Variable(inputs_test.cuda())
+        if full_resolution == 'tiled':
+            preds = [predict_tiled(net, image, batch_size=batch_size) for image in data_test['original']]
+        elif full_resolution == 'refined':
+            preds = [predict_refined(net, image, batch_size=batch_size) for image in data_test['original']]
         else:
-            inputs_test = Variable(inputs_test)
-
-        d1,d2,d3,d4,d5,d6,d7= net(inputs_test)
-
-        # normalization
-        pred = d1[:,0,:,:]
-        pred = normPRED(pred)
+            d0 = forward_batch(net, data_test['image'])
+            preds = split_batch(d0, data_test['size'])
 
         # save results to test_results folder
-        if not os.path.exists(prediction_dir):
-            os.makedirs(prediction_dir, exist_ok=True)
-        save_output(img_name_list[i_test],pred,prediction_dir)
+        for image_name, pred in zip(data_test['name'], preds):
+            sink.submit(save_output,image_name,pred,prediction_dir)
 
-        del d1,d2,d3,d4,d5,d6,d7
+    sink.close()
 
 if __name__ == "__main__":
     main()
@@ -12,6 +12,7 @@ from torchvision import transforms#, utils
 import numpy as np
 from PIL import Image
 import glob
+import time
 import cv2
 
 from data_loader import RescaleT
@@ -23,8 +24,11 @@ from data_loader import ColorJitter
 
 
 
-from model import U2NET # full size version 173.6 MB
-from model import U2NETP # small version u2net 4.7 MB
+from inference import load_net
+from inference import forward_batch
+from inference import PriorStream
+from inference import FrameGate
+from output_sink import OutputSink
 
 # normalize the predicted SOD probability map
 def normPRED(d):
@@ -35,6 +39,29 @@ def normPRED(d):
 
     return dn
 
+def save_outputs(output_dir, i_test, inputs, pred, save_prior=True):
+
+    input_image = inputs[:3] * 255
+
+    if inputs.shape[0] == 4:
+        prior = inputs[3] * 255
+        # print('prior_shape', prior.shape)
+
+    input_image = np.moveaxis(input_image, 0, 2)
+    input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)
+
+    final_image = cv2.cvtColor(input_image, cv2.COLOR_RGB2RGBA)
+    final_image[:,:,3] = pred
+
+    image_pil = Image.fromarray(np.uint8(final_image))
+
+    image_pil.save(os.path.join(output_dir, str(i_test)+'_final_output.png')+'.png')
+
+    cv2.imwrite(os.path.join(output_dir, str(i_test)+'_pred.png'), pred)
+    cv2.imwrite(os.path.join(output_dir, str(i_test)+'_inputs.png'), input_image)
+    if inputs.shape[0] == 4 and save_prior:
+        cv2.imwrite(os.path.join(output_dir, str(i_test)+'_prior.png'), prior)
+
 def main():
     # filename_list = glob.glob('/home/xkaple00/JUPYTER_SHARED/Digis/Background_removal/U-2-Net/train_data/FINAL3_combined')
     # --------- 1. get image path and name ---------
@@ -66,9 +93,18 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    img_name_list = glob.glob(image_dir + os.sep + '*')
+    # True: feed every frame's prediction back in as the prior of the next frame,
+    # the spin is processed in one pass and prior_dir is not read
+    stream_prior = False
+
+    # e.g. 0.01: reuse the previous mask when no 8x8 cell of a 64x64 thumbnail changed by more than
+    # that (start/end of a spin, paused turntable), see FrameGate; None runs the model on every frame
+    gate_threshold = None
+    gate_warp = False
+
+    img_name_list = sorted(glob.glob(image_dir + os.sep + '*'))
     # lbl_name_list = glob.glob(label_dir + os.sep + '*')
-    pri_name_list = glob.glob(prior_dir + os.sep + '*')
+    pri_name_list = [] if stream_prior else glob.glob(prior_dir + os.sep + '*')
     lbl_name_list = []
     # pri_name_list = []
 
@@ -100,23 +136,26 @@ def main():
                                         num_workers=1)
 
     # --------- 3. model define ---------
-    if(model_name=='u2net'):
-        print("...load U2NET---173.6 MB")
-        net = U2NET(4,1)
-        net.load_state_dict(torch.load(model_dir))
-
-    elif(model_name=='u2netp'):
-        print("...load U2NEP---4.7 MB")
-        net = U2NETP(4,1)
-        net.load_state_dict(torch.load(model_dir))
-
-    if torch.cuda.is_available():
-        net.cuda()
-    
-    net.eval()
+    net = load_net(model_name, model_dir, in_ch=4, fuse=True)
 
     # net = net.load_state_dict(torch.load(model_dir))
 
+    if stream_prior:
+        prior_stream = PriorStream(net)
+
+    def infer(inputs):
+        if stream_prior:
+            return prior_stream(inputs)[1]
+        return forward_batch(net, inputs)
+
+    gate = None
+    if gate_threshold is not None:
+        gate = FrameGate(gate_threshold, warp=gate_warp)
+
+    sink = OutputSink(num_workers=4, max_pending=16)
+
+    start = time.perf_counter()
+
     # --------- 4. inference for each image ---------
     for i_test, data_test in enumerate(test_salobj_dataloader):
 
@@ -127,12 +166,10 @@ def main():
         # height, width = inputs_test.shape[2:]
         inputs_test = inputs_test.type(torch.FloatTensor)
 
-        if torch.cuda.is_available():
-            inputs_test = Variable(inputs_test.cuda())
+        if gate is not None:
+            d0 = gate(inputs_test, infer)
         else:
-            inputs_test = Variable(inputs_test)
-
-        d0,d1,d2,d3,d4,d5,d6 = net(inputs_test)
+            d0 = infer(inputs_test)
 
         # normalization
         pred = d0[0,0,:,:] * 255
@@ -141,29 +178,16 @@ def main():
         print('pred_shape', pred.shape)
 
         inputs = inputs_test.cpu().detach().numpy()[0]
-        input_image = inputs[:3] * 255
-
-        if inputs.shape[0] == 4:
-            prior = inputs[3] * 255
-            # print('prior_shape', prior.shape)
-
-        input_image = np.moveaxis(input_image, 0, 2)
-        input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)
-
-        final_image = cv2.cvtColor(input_image, cv2.COLOR_RGB2RGBA)
-        print('final_image_shape', final_image.shape)
-        final_image[:,:,3] = pred
 
-        image_pil = Image.fromarray(np.uint8(final_image))
+        # composite, encode and write in the background, the loop only waits on the model
+        sink.submit(save_outputs, output_dir, i_test, inputs, pred, not stream_prior)
 
-        image_pil.save(os.path.join(output_dir, str(i_test)+'_final_output.png')+'.png')
+        del d0
 
-        cv2.imwrite(os.path.join(output_dir, str(i_test)+'_pred.png'), pred)
-        cv2.imwrite(os.path.join(output_dir, str(i_test)+'_inputs.png'), input_image)
-        if inputs.shape[0] == 4:
-            cv2.imwrite(os.path.join(output_dir, str(i_test)+'_prior.png'), prior) 
+    sink.close()
 
-        del d0,d1,d2,d3,d4,d5,d6
+    if gate is not None:
+        print(gate.summary(time.perf_counter() - start))
 
 if __name__ == "__main__":
     main()
@@ -10,6 +10,10 @@ import torch.optim as optim
 import torchvision.transforms as standard_transforms
 
 import numpy as np
+import random
+import contextlib
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import glob
 import os
 import cv2
@@ -22,30 +26,60 @@ from data_loader import ToTensorLab
 from data_loader import SalObjDataset
 from data_loader import Augment_prior
 from data_loader import ColorJitter
+from data_loader import ToTensorUint8
+from data_loader import normalize_batch
+from data_loader import salobj_name_lists
+from data_loader import CachedSalObjDataset
+from data_loader import ShardedSalObjDataset
+from data_loader import StackSample
+from data_loader import RescaleStackedT
+from data_loader import AugmentPriorStacked
+from data_loader import ColorJitterStacked
+from data_loader import ToTensorStacked
+from data_loader import BatchAugment
 
 from model import U2NET
 from model import U2NETP
+from model import LogitsOutput
+from model import set_activation_checkpointing
+
+from train_utils import forward_loss
+from train_utils import output_probability
+from train_utils import TrainMetrics
+from train_utils import ResumableSampler
+from train_utils import cpu_copy
+from train_utils import training_checkpoint
+from train_utils import save_atomic
+from train_utils import load_training_checkpoint
+from train_utils import scheduled_size
+from train_utils import scaled_batch_size
+from output_sink import OutputSink
+
+# distributed data parallel on CPU: `torchrun --nproc_per_node=<sockets> u2net_train.py`, or with
+# --nnodes/--rdzv-endpoint across machines. Every process trains batch_size_train samples per step on
+# its part of the data (DistributedSampler / its shards), gradients are averaged over gloo.
+# Only rank 0 logs and writes checkpoints. Resume with the same number of processes.
+distributed = int(os.environ.get('WORLD_SIZE', '1')) > 1
+if distributed:
+    dist.init_process_group('gloo')
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    # torchrun defaults OMP_NUM_THREADS to 1, share the cores of the machine between the local processes instead
+    if 'OMP_NUM_THREADS' not in os.environ or os.environ['OMP_NUM_THREADS'] == '1':
+        torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', '1'))))
+else:
+    rank = 0
+    world_size = 1
+is_main = rank == 0
 
 # ------- 1. define loss function --------
 
-bce_loss = nn.BCELoss(size_average=True)
-
-def muti_bce_loss_fusion(d0, d1, d2, d3, d4, d5, d6, labels_v):
-
-	loss0 = bce_loss(d0,labels_v)
-	loss1 = bce_loss(d1,labels_v)
-	loss2 = bce_loss(d2,labels_v)
-	loss3 = bce_loss(d3,labels_v)
-	loss4 = bce_loss(d4,labels_v)
-	loss5 = bce_loss(d5,labels_v)
-	loss6 = bce_loss(d6,labels_v)
-
-	loss = loss0 + loss1 + loss2 + loss3 + loss4 + loss5 + loss6
-	# print("l0: %3f, l1: %3f, l2: %3f, l3: %3f, l4: %3f, l5: %3f, l6: %3f\n"%(loss0.data[0],loss1.data[0],loss2.data[0],loss3.data[0],loss4.data[0],loss5.data[0],loss6.data[0]))
-	print("l0: %3f, l1: %3f, l2: %3f, l3: %3f, l4: %3f, l5: %3f, l6: %3f\n"%(loss0.data,loss1.data,loss2.data,loss3.data,loss4.data,loss5.data,loss6.data))
-
-
-	return loss0, loss
+# see train_utils.py: muti_bce_loss_fusion on the sigmoid outputs, or one BCE-with-logits over
+# the stacked [7,B,1,H,W] logits of forward_logits
+# 'logits' or 'sigmoid'
+loss_mode = 'logits'
+# bfloat16 autocast for the forward pass (loss_mode 'logits' only)
+bf16 = False
 
 
 # ------- 2. set the directory of training dataset --------
@@ -71,8 +105,9 @@ tra_prior_dir = os.path.join('FINAL5.1_MATTE_predicted_1' + os.sep)
 # tra_image_dir = os.path.join('test1_image' + os.sep)
 # tra_label_dir = os.path.join('test1_matte' + os.sep)
 
-print("tra_image_dir", tra_image_dir)
-print("tra_label_dir", tra_label_dir)
+if is_main:
+    print("tra_image_dir", tra_image_dir)
+    print("tra_label_dir", tra_label_dir)
 
 # image_ext = '.jpg'
 image_ext = '.png'
@@ -97,42 +132,89 @@ batch_size_val = 1
 train_num = 0
 val_num = 0
 
-print('datadir', data_dir + tra_image_dir + '*' + image_ext)
+if is_main:
+    print('datadir', data_dir + tra_image_dir + '*' + image_ext)
 # print('labeldir', data_dir + tra_label_dir + imidx + label_ext)
 
-tra_img_name_list = glob.glob(data_dir + tra_image_dir + '*' + image_ext)
-
-tra_lbl_name_list = []
-tra_pri_name_list = []
-for img_path in tra_img_name_list:
-	img_name = img_path.split(os.sep)[-1]
-
-	aaa = img_name.split(".")
-	bbb = aaa[0:-1]
-	imidx = bbb[0]
-	for i in range(1,len(bbb)):
-		imidx = imidx + "." + bbb[i]
-
-	tra_lbl_name_list.append(data_dir + tra_label_dir + imidx + label_ext)
-	tra_pri_name_list.append(data_dir + tra_prior_dir + imidx + prior_ext)
-
-print("---")
-print("train images: ", len(tra_img_name_list))
-print("train labels: ", len(tra_lbl_name_list))
-print("train prior: ", len(tra_pri_name_list))
-print("---")
-
-salobj_dataset = SalObjDataset(
-    img_name_list=tra_img_name_list,
-    lbl_name_list=tra_lbl_name_list,
-    pri_name_list=tra_pri_name_list,
-    transform=transforms.Compose([
-        Augment_prior(0.5),
-        RescaleT((320,320)),
+tra_img_name_list, tra_lbl_name_list, tra_pri_name_list = salobj_name_lists(
+    data_dir + tra_image_dir, data_dir + tra_label_dir, data_dir + tra_prior_dir, image_ext, label_ext, prior_ext)
+
+if is_main:
+    print("---")
+    print("train images: ", len(tra_img_name_list))
+    print("train labels: ", len(tra_lbl_name_list))
+    print("train prior: ", len(tra_pri_name_list))
+    print("---")
+
+# 'uint8': workers send uint8 tensors and the batch is scaled to float once in the main process,
+# 'float': workers send the float64 arrays of ToTensorLab
+transport = 'uint8'
+num_workers = 4
+
+# 'png': decode the PNG folders every epoch,
+# 'cache': read the pre-resized memory-mapped cache built by `python prepare_data.py cache`,
+# 'shards': stream the tar shards written by `python prepare_data.py shards`
+data_format = 'png'
+cache_path = data_dir + 'FINAL5.1_320.npy'
+shard_dir = data_dir + 'FINAL5.1_shards'
+
+# 'pil': the per-channel PIL transforms, 'stacked': image, label and prior travel as one HxWx5 uint8
+# array with one cv2 call per resize/warp. Not identical augmentation: cv2 INTER_AREA/bilinear resize,
+# prior warped after resizing, always uint8 transport
+pipeline = 'pil'
+
+# True: color jitter and prior augmentation run once per collated batch (BatchAugment) instead of
+# per sample in the workers, the workers then only decode and resize. Not identical augmentation:
+# YIQ hue rotation, fixed jitter order, prior warped after resizing
+batch_augment = False
+
+def make_train_transform(size):
+    if pipeline == 'stacked':
+        return transforms.Compose([
+            StackSample(),
+            RescaleStackedT(size)] +
+            ([] if batch_augment else [
+            AugmentPriorStacked(0.5),
+            ColorJitterStacked(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05)]) + [
+            ToTensorStacked()])
+
+    return transforms.Compose(
+        ([] if batch_augment else [Augment_prior(0.5)]) + [
+        RescaleT(size)] +
         # RandomCrop(288), #root cause of misalignment of label and input
-        ColorJitter(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05),
-        ToTensorLab(flag=0)]))
-salobj_dataloader = DataLoader(salobj_dataset, batch_size=batch_size_train, shuffle=True, num_workers=1)
+        ([] if batch_augment else [ColorJitter(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05)]) + [
+        ToTensorUint8() if transport == 'uint8' else ToTensorLab(flag=0)])
+
+# progressive resolution: (first epoch, size) steps, e.g. [(0,160), (20,224), (40,320)]; U2NET is
+# fully convolutional, so early epochs can train on smaller images. With scale_batch_size the batch
+# grows to batch_size_train * (320/size)^2, keeping the pixels per step (and the memory) constant.
+resolution_schedule = [(0, 320)]
+scale_batch_size = True
+
+def make_train_dataloader(size):
+    # the dataset and sampler stay, workers are started per epoch and pick up the new transform
+    salobj_dataset.transform = make_train_transform((size,size))
+    batch_size = scaled_batch_size(batch_size_train, size) if scale_batch_size else batch_size_train
+
+    return DataLoader(salobj_dataset, batch_size=batch_size, sampler=train_sampler, num_workers=num_workers)
+
+batch_augment_fn = BatchAugment(brightness=(0.8,1.2),contrast=(0.8,1.2),saturation=(0.9,1.1),hue=0.05,prior_prob=0.5) if batch_augment else None
+
+if data_format == 'cache':
+    # samples are already 320x320, the prior is distorted after resizing
+    salobj_dataset = CachedSalObjDataset(cache_path, transform=make_train_transform((320,320)))
+elif data_format == 'shards':
+    salobj_dataset = ShardedSalObjDataset(shard_dir, transform=make_train_transform((320,320)), num_replicas=world_size, rank=rank)
+else:
+    salobj_dataset = SalObjDataset(
+        img_name_list=tra_img_name_list,
+        lbl_name_list=tra_lbl_name_list,
+        pri_name_list=tra_pri_name_list,
+        transform=make_train_transform((320,320)))
+# shards are shuffled by the dataset itself, the other formats by a sampler that can resume mid-epoch
+train_sampler = ResumableSampler(salobj_dataset, num_replicas=world_size, rank=rank) if data_format != 'shards' else None
+salobj_dataloader = None
+train_size = None
 
 # ------- 3. define model --------
 # define the net
@@ -146,106 +228,171 @@ elif(model_name=='u2netp'):
 if torch.cuda.is_available():
     net.cuda()
 
+# recompute these stages in backward to save memory for larger batches / sizes, see STAGE_GROUPS in
+# model/u2net.py: 'none', 'high-res', 'encoder', 'decoder', 'all' or a list of stage names
+activation_checkpointing = 'none'
+set_activation_checkpointing(net, activation_checkpointing)
+
+# the module that is called in the training step, net itself keeps the checkpointed weights
+train_net = LogitsOutput(net) if loss_mode == 'logits' else net
+if distributed:
+    # broadcasts rank 0's weights at construction
+    train_net = DistributedDataParallel(train_net)
+
 # ------- 4. define optimizer --------
-print("---define optimizer...")
+if is_main:
+    print("---define optimizer...")
 optimizer = optim.Adam(net.parameters(), lr=0.001, betas=(0.9, 0.999), eps=1e-08, weight_decay=0) # lr = 0.001
 
 # ------- 5. training process --------
-print("---start training...")
+if is_main:
+    print("---start training...")
 ite_num = 0
 running_loss = 0.0
 running_tar_loss = 0.0
 ite_num4val = 0
 save_freq = 2000 # save the model every 2000 iterations
-
-for epoch in range(0, epoch_num):
+# full checkpoint (weights, optimizer, iteration, epoch, data position, RNG) rewritten every save_freq
+# iterations; set resume_path to it to continue a run. Shards restart the interrupted epoch.
+checkpoint_path = "saved_models/u2netp/last_checkpoint.pth"
+resume_path = None
+# checkpoints and debug images are serialized and written off the training thread, in order
+checkpoint_sink = OutputSink(num_workers=1, max_pending=16) if is_main else None
+log_freq = 100 # loss and throughput every 100 iterations, see TrainMetrics
+metrics = TrainMetrics(log_freq, "saved_models/u2netp/train_log.jsonl", world_size) if is_main else None
+
+start_epoch = 0
+position = 0 # samples of the current epoch already trained on
+if resume_path is not None:
+    ite_num, start_epoch, position = load_training_checkpoint(resume_path, net, optimizer)
+    if rank > 0:
+        # the checkpoint holds the RNG states of rank 0, the other ranks need their own augmentation streams
+        seed = ite_num * world_size + rank
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        torch.manual_seed(seed)
+    if is_main:
+        print("resumed from %s at ite %d, epoch %d, sample %d" % (resume_path, ite_num, start_epoch + 1, position))
+
+for epoch in range(start_epoch, epoch_num):
     net.train()
-
-    for i, data in enumerate(salobj_dataloader):
-        ite_num = ite_num + 1
-        ite_num4val = ite_num4val + 1
-
-        inputs, labels = data['image'], data['label']
-
-        inputs = inputs.type(torch.FloatTensor)
-        labels = labels.type(torch.FloatTensor)
-
-        # print('inputs_size', inputs.size())
-        # print('labels_size', labels.size())
-
-        # wrap them in Variable
-        if torch.cuda.is_available():
-            inputs_v, labels_v = Variable(inputs.cuda(), requires_grad=False), Variable(labels.cuda(),
-                                                                                        requires_grad=False)
-        else:
-            inputs_v, labels_v = Variable(inputs, requires_grad=False), Variable(labels, requires_grad=False)
-
-        # y zero the parameter gradients
-        optimizer.zero_grad()
-
-        # forward + backward + optimize
-        d0, d1, d2, d3, d4, d5, d6 = net(inputs_v)
-        loss2, loss = muti_bce_loss_fusion(d0, d1, d2, d3, d4, d5, d6, labels_v)
-
-        loss.backward()
-        optimizer.step()
-
-        # # print statistics
-        # running_loss += loss.data[0]
-        # running_tar_loss += loss2.data[0]
-        
-        running_loss += loss.data
-        running_tar_loss += loss2.data
+    if data_format == 'shards':
+        salobj_dataset.set_epoch(epoch)
+        position = 0
+    elif epoch == start_epoch:
+        train_sampler.resume(epoch, position)
+    else:
+        train_sampler.set_epoch(epoch)
+        position = 0
+
+    if scheduled_size(resolution_schedule, epoch) != train_size:
+        train_size = scheduled_size(resolution_schedule, epoch)
+        salobj_dataloader = make_train_dataloader(train_size)
+        if is_main:
+            print("epoch %d: training at %dx%d, batch size %d" % (epoch + 1, train_size, train_size, salobj_dataloader.batch_size))
+
+    # shards can give the processes different numbers of batches, join() keeps the finished ones
+    # answering the gradient all-reduces of the others
+    with (train_net.join() if distributed else contextlib.nullcontext()):
+        for i, data in enumerate(salobj_dataloader):
+            if is_main:
+                metrics.data_ready()
+            ite_num = ite_num + 1
+            ite_num4val = ite_num4val + 1
+
+            if transport == 'uint8' or pipeline == 'stacked':
+                data = normalize_batch(data)
+            if batch_augment_fn is not None:
+                data = batch_augment_fn(data)
+            inputs, labels = data['image'], data['label']
+
+            inputs = inputs.type(torch.FloatTensor)
+            labels = labels.type(torch.FloatTensor)
+
+            # print('inputs_size', inputs.size())
+            # print('labels_size', labels.size())
+
+            # wrap them in Variable
+            if torch.cuda.is_available():
+                inputs_v, labels_v = Variable(inputs.cuda(), requires_grad=False), Variable(labels.cuda(),
+                                                                                            requires_grad=False)
+            else:
+                inputs_v, labels_v = Variable(inputs, requires_grad=False), Variable(labels, requires_grad=False)
+
+            # y zero the parameter gradients
+            optimizer.zero_grad()
+
+            # forward + backward + optimize
+            outputs, loss2, loss = forward_loss(train_net, inputs_v, labels_v, loss_mode, bf16)
+
+            loss.backward()
+            optimizer.step()
+
+            # # print statistics
+            # running_loss += loss.data[0]
+            # running_tar_loss += loss2.data[0]
         
-
-        print("[epoch: %3d/%3d, batch: %5d/%5d, ite: %d] train loss: %3f, tar: %3f " % (
-        epoch + 1, epoch_num, (i + 1) * batch_size_train, train_num, ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val))
-
-        if ite_num % save_freq == 0:
+            # summed on the device, only read back when a checkpoint is named
+            running_loss += loss.detach()
+            running_tar_loss += loss2.detach()
+            if is_main:
+                metrics.step(loss, loss2, inputs.shape[0], epoch + 1, ite_num)
+            position += inputs.shape[0]
+
+            if ite_num % save_freq == 0 and is_main:
             
-            #save state dictionary only
-            torch.save(net.state_dict(), "saved_models/u2netp/itr_%d_train_%3f_tar_%3f.pth" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val))
+                #save state dictionary only
+                checkpoint_sink.submit(torch.save, cpu_copy(net.state_dict()), "saved_models/u2netp/itr_%d_train_%3f_tar_%3f.pth" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val))
+                #save everything needed to resume
+                checkpoint_sink.submit(save_atomic, training_checkpoint(net, optimizer, ite_num, epoch, position), checkpoint_path)
 
-            #save entire model
-            # torch.save(net, "saved_models/u2netp/itr_%d_train_%3f_tar_%3f.pth" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val))
+                #save entire model
+                # torch.save(net, "saved_models/u2netp/itr_%d_train_%3f_tar_%3f.pth" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val))
 
-            running_loss = 0.0
-            running_tar_loss = 0.0
-            net.train()  # resume train
+                running_loss = 0.0
+                running_tar_loss = 0.0
+                net.train()  # resume train
 
-            # middle_output = (d0[0][0] + d1[0][0] + d2[0][0] + d3[0][0] + d4[0][0] + d5[0][0] + d6[0][0]) / 7 * 255
+                # middle_output = (d0[0][0] + d1[0][0] + d2[0][0] + d3[0][0] + d4[0][0] + d5[0][0] + d6[0][0]) / 7 * 255
             
-            middle_output = d0[0][0] * 255
+                middle_output = output_probability(outputs, loss_mode)[0][0] * 255
+
+                middle_output = middle_output.cpu().detach().numpy()
+                middle_input = inputs.cpu().detach().numpy()[0][:3]
+                middle_input = np.moveaxis(middle_input, 0, 2) * 255
+                middle_prior = inputs.cpu().detach().numpy()[0][3] * 255
 
-            middle_output = middle_output.cpu().detach().numpy()
-            middle_input = inputs.cpu().detach().numpy()[0][:3]
-            middle_input = np.moveaxis(middle_input, 0, 2) * 255
-            middle_prior = inputs.cpu().detach().numpy()[0][3] * 255
+                middle_label = labels.cpu().detach().numpy()[0][0] * 255
 
-            middle_label = labels.cpu().detach().numpy()[0][0] * 255
+                # print('middle_input', middle_input.shape)
+                # print('middle_prior', middle_prior.shape)
 
-            # print('middle_input', middle_input.shape)
-            # print('middle_prior', middle_prior.shape)
 
+                # cv2.imwrite(model_dir + "saved_models/u2netp/_output_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_output)
+                # cv2.imwrite(model_dir + "_input_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), cv2.cvtColor(middle_input, cv2.COLOR_BGR2RGB))
+                # cv2.imwrite(model_dir + "_prior_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior)
+                # cv2.imwrite(model_dir + "_difference_prior_output_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior - middle_output)
+                # cv2.imwrite(model_dir + "_difference_prior_label_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior - middle_label)
+                # cv2.imwrite(model_dir + "_difference_output_label_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_output - middle_label)
 
-            # cv2.imwrite(model_dir + "saved_models/u2netp/_output_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_output)
-            # cv2.imwrite(model_dir + "_input_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), cv2.cvtColor(middle_input, cv2.COLOR_BGR2RGB))
-            # cv2.imwrite(model_dir + "_prior_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior)
-            # cv2.imwrite(model_dir + "_difference_prior_output_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior - middle_output)
-            # cv2.imwrite(model_dir + "_difference_prior_label_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_prior - middle_label)
-            # cv2.imwrite(model_dir + "_difference_output_label_bce_itr_%d_train_%3f_tar_%3f.png" % (ite_num, running_loss / ite_num4val, running_tar_loss / ite_num4val), middle_output - middle_label)
+                checkpoint_sink.imwrite("saved_models/u2netp/output_itr_%d.png" % (ite_num), middle_output)
+                checkpoint_sink.imwrite("saved_models/u2netp/input_itr_%d.png" % (ite_num), cv2.cvtColor(middle_input, cv2.COLOR_BGR2RGB))
+                checkpoint_sink.imwrite("saved_models/u2netp/prior_itr_%d.png" % (ite_num), middle_prior)
+                checkpoint_sink.imwrite("saved_models/u2netp/difference_prior_output_itr_%d.png" % (ite_num), middle_prior - middle_output)
+                checkpoint_sink.imwrite("saved_models/u2netp/difference_prior_label_itr_%d.png" % (ite_num), middle_prior - middle_label)
+                checkpoint_sink.imwrite("saved_models/u2netp/difference_output_label_itr_%d.png" % (ite_num), middle_output - middle_label)
 
-            cv2.imwrite("saved_models/u2netp/output_itr_%d.png" % (ite_num), middle_output)
-            cv2.imwrite("saved_models/u2netp/input_itr_%d.png" % (ite_num), cv2.cvtColor(middle_input, cv2.COLOR_BGR2RGB))
-            cv2.imwrite("saved_models/u2netp/prior_itr_%d.png" % (ite_num), middle_prior)
-            cv2.imwrite("saved_models/u2netp/difference_prior_output_itr_%d.png" % (ite_num), middle_prior - middle_output)
-            cv2.imwrite("saved_models/u2netp/difference_prior_label_itr_%d.png" % (ite_num), middle_prior - middle_label)
-            cv2.imwrite("saved_models/u2netp/difference_output_label_itr_%d.png" % (ite_num), middle_output - middle_label)
+                ite_num4val = 0
 
-            ite_num4val = 0
+            # del temporary outputs and loss
+            del outputs, loss2, loss
 
-        # del temporary outputs and loss
-        del d0, d1, d2, d3, d4, d5, d6, loss2, loss
+if is_main:
+    metrics.log(epoch_num, ite_num)
+    metrics.close()
+    checkpoint_sink.close()
+if distributed:
+    dist.destroy_process_group()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+# background removal straight from a video file to composited / alpha video files
+#
+#   python u2net_video.py --model u2netp --in-ch 4 --weights saved_models/u2netp/Best1_320px.pth \
+#       --input spin.mp4 --output spin_composited.mp4 --alpha-output spin_alpha.mp4
+#
+# Decoding (cv2.VideoCapture), inference and encoding (cv2.VideoWriter) run in three
+# threads connected by bounded queues, so the model never waits on video I/O and a slow
+# stage only blocks its producer once its queue is full.
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from inference import load_net
+from inference import input_channels
+from inference import prepare_batch
+from inference import forward_batch
+from inference import PriorStream
+from inference import FrameGate
+
+_END = object()
+
+
+def _put(q, item, stop):
+    # blocking put that gives up once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _END
+
+def decode(capture, decoded, in_ch, size, stop):
+    # BGR frame + its 1 x in_ch x 320 x 320 model input
+    try:
+        while not stop.is_set():
+            ok, frame = capture.read()
+            if not ok:
+                break
+            inputs = prepare_batch([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)], size=size, in_ch=in_ch)
+            _put(decoded, (frame, inputs), stop)
+    finally:
+        capture.release()
+        _put(decoded, _END, stop)
+
+def infer(net, decoded, predicted, stream_prior, gate, stop):
+    # frame + HxW float32 mask at the frame resolution
+    prior_stream = PriorStream(net) if stream_prior else None
+
+    def run(inputs):
+        if prior_stream is not None:
+            return prior_stream(inputs)[1]
+        return forward_batch(net, inputs)
+
+    while True:
+        item = _get(decoded, stop)
+        if item is _END:
+            break
+        frame, inputs = item
+
+        d0 = gate(inputs, run) if gate is not None else run(inputs)
+        mask = cv2.resize(d0[0,0].cpu().numpy(), (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+        _put(predicted, (frame, mask), stop)
+
+    _put(predicted, _END, stop)
+
+def encode(predicted, writer, alpha_writer, background, stats, stop):
+    while True:
+        item = _get(predicted, stop)
+        if item is _END:
+            break
+        frame, mask = item
+
+        alpha = mask[:,:,np.newaxis]
+        composited = frame * alpha + background * (1 - alpha)
+        writer.write(np.uint8(np.clip(composited, 0, 255)))
+        if alpha_writer is not None:
+            alpha_writer.write(cv2.cvtColor(np.uint8(np.clip(mask * 255, 0, 255)), cv2.COLOR_GRAY2BGR))
+
+        stats['frames'] += 1
+
+def run_threads(targets, stop):
+    # start one thread per (function, args), stop all of them on the first error and re-raise it
+    errors = []
+
+    def guard(target, args):
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=guard, args=(target, args), daemon=True) for target, args in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="U2NET / U2NETP background removal for video files")
+    parser.add_argument('--model', default='u2netp', choices=['u2net','u2netp'])
+    parser.add_argument('--weights', required=True, help="state_dict .pth, or .pt/.onnx, see load_net")
+    parser.add_argument('--in-ch', type=int, default=4, choices=[3,4])
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True, help="video composited over --background")
+    parser.add_argument('--alpha-output', default=None, help="optional grayscale alpha matte video")
+    parser.add_argument('--background', type=int, nargs=3, default=[255,255,255], help="B G R")
+    parser.add_argument('--fourcc', default='mp4v')
+    parser.add_argument('--gate-threshold', type=float, default=None, help="skip near-static frames, see FrameGate")
+    parser.add_argument('--queue-size', type=int, default=8)
+    args = parser.parse_args()
+
+    net = load_net(args.model, args.weights, args.in_ch, fuse=not args.weights.endswith(('.pt','.onnx')))
+    in_ch = input_channels(net)
+
+    capture = cv2.VideoCapture(args.input)
+    if not capture.isOpened():
+        raise IOError("cannot open video %s" % args.input)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    fourcc = cv2.VideoWriter_fourcc(*args.fourcc)
+    writer = cv2.VideoWriter(args.output, fourcc, fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise IOError("cannot open video writer %s (fourcc %s)" % (args.output, args.fourcc))
+    alpha_writer = None
+    if args.alpha_output is not None:
+        alpha_writer = cv2.VideoWriter(args.alpha_output, fourcc, fps, (width, height))
+        if not alpha_writer.isOpened():
+            capture.release()
+            writer.release()
+            raise IOError("cannot open video writer %s (fourcc %s)" % (args.alpha_output, args.fourcc))
+
+    gate = FrameGate(args.gate_threshold) if args.gate_threshold is not None else None
+    background = np.array(args.background, dtype=np.float32)
+
+    decoded = queue.Queue(maxsize=args.queue_size)
+    predicted = queue.Queue(maxsize=args.queue_size)
+    stats = {'frames': 0}
+    stop = threading.Event()
+
+    start = time.perf_counter()
+    try:
+        run_threads([
+            (decode, (capture, decoded, in_ch, (320,320), stop)),
+            (infer, (net, decoded, predicted, in_ch == 4, gate, stop)),
+            (encode, (predicted, writer, alpha_writer, background, stats, stop)),
+        ], stop)
+    finally:
+        writer.release()
+        if alpha_writer is not None:
+            alpha_writer.release()
+    elapsed = time.perf_counter() - start
+
+    print("%d frames in %.1f s, %.2f frames/s" % (stats['frames'], elapsed, stats['frames'] / elapsed))
+    if gate is not None:
+        print(gate.summary(elapsed))
+
+if __name__ == "__main__":
+    main()